@@ -0,0 +1,97 @@
+#
+# Copyright © 2022 Tingdahl ICT Management
+# Licenced under the MIT licence, see license.md
+#
+
+import threading
+from . import tracer
+
+# Write the cache at least this often while messages are completed
+CACHE_WRITE_INTERVAL_SECONDS = 5
+
+# Write the cache immediately when this many messages are completed
+CACHE_WRITE_BATCH = 200
+
+
+# Adds completed messages to the cache, and writes the cache file from a
+# background thread. The processing threads only append to the cache; the
+# file is written when CACHE_WRITE_BATCH messages are completed, or at least
+# every CACHE_WRITE_INTERVAL_SECONDS. Messages from all threads are thereby
+# committed together, and no processing thread waits for the disk.
+
+class CacheWriter:
+    __slots__ = '_cache', '_filename', '_lock', '_pending', '_wakeup', \
+                '_stop', '_thread'
+
+    def __init__(self, cache, filename):
+        self._cache = cache
+        self._filename = filename
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._filename is None or self._thread is not None:
+            return
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=writeThreadFunction,
+                                        args=(self,), daemon=True,
+                                        name="cache-writer")
+        self._thread.start()
+
+    # Stop the background thread and write what is not written yet
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._wakeup.set()
+            self._thread.join()
+            self._thread = None
+
+        self.flush()
+
+    # Add a completed message to the cache
+    def add(self, messageid):
+        with self._lock:
+            self._cache._foldersidslist[messageid._folder].add(messageid._id)
+            self._pending += 1
+            if self._pending >= CACHE_WRITE_BATCH:
+                self._wakeup.set()
+
+    # Write the cache file if messages are completed since the last write
+    def flush(self):
+        if self._filename is None:
+            return True
+
+        with self._lock:
+            if self._pending == 0:
+                return True
+
+            snapshot = self._cache.copy()
+            pending = self._pending
+            self._pending = 0
+
+        with tracer.span('cache write'):
+            written = snapshot.writeJSonFile(self._filename)
+
+        if written is False:
+            with self._lock:
+                self._pending += pending
+
+            return False
+
+        return True
+
+    def writeThreadFunction(self):
+        while not self._stop.is_set():
+            self._wakeup.wait(CACHE_WRITE_INTERVAL_SECONDS)
+            self._wakeup.clear()
+            self.flush()
+
+
+# Wrapper function for writeThreadFunction
+
+def writeThreadFunction(obj):
+    obj.writeThreadFunction()
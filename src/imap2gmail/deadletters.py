@@ -0,0 +1,123 @@
+#
+# Copyright © 2022 Tingdahl ICT Management
+# Licenced under the MIT licence, see license.md
+#
+
+import json
+import logging
+import os
+import threading
+from .imapreader import ImapMessageID
+
+FETCH_ERROR = 'fetch'
+
+# The message could not be written to the spool
+SPOOL_ERROR = 'spool'
+
+# The message is in the cache, but not found in GMail by --verify
+MISSING_ERROR = 'missing'
+
+
+# A message that could not be imported, with the class of the last error and
+# the number of attempts.
+class DeadLetter:
+    __slots__ = '_messageid', '_errorclass', '_error', '_retryable', \
+                '_attempts'
+
+    def __init__(self, messageid, errorclass, error, retryable, attempts):
+        self._messageid = messageid
+        self._errorclass = errorclass
+        self._error = error
+        self._retryable = retryable
+        self._attempts = attempts
+
+    def json_serialize(self):
+        result = self._messageid.json_serialize()
+        result.update({'errorclass': self._errorclass,
+                       'error': self._error,
+                       'retryable': self._retryable,
+                       'attempts': self._attempts})
+        return result
+
+
+# Persistent list of failed messages. Messages are added by the processing
+# threads when they fail, and removed when they are imported.
+class DeadLetterList:
+    __slots__ = '_filename', '_deadletters', '_lock'
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._deadletters = {}
+        self._lock = threading.Lock()
+
+    # Load list from json file
+    def loadJsonFile(self):
+        if not self._filename or not os.path.exists(self._filename):
+            return True
+
+        try:
+            with open(self._filename, 'rb') as file:
+                importlist = json.load(file)
+        except (OSError, ValueError) as err:
+            logging.error(f"Could not read dead letter file "
+                          f"{self._filename}: {err}")
+            return False
+
+        for item in importlist:
+            messageid = ImapMessageID(item[ImapMessageID.folderKey],
+                                      item[ImapMessageID.idKey])
+            self._deadletters[(messageid._folder, messageid._id)] = \
+                DeadLetter(messageid, item['errorclass'], item['error'],
+                           item['retryable'], item['attempts'])
+
+        logging.info(f"Loaded {len(importlist)} failed messages from "
+                     f"{self._filename}.")
+        return True
+
+    # Write list to json file. The file is replaced atomically.
+    def writeJsonFile(self):
+        if not self._filename:
+            return True
+
+        with self._lock:
+            exportlist = [deadletter.json_serialize()
+                          for deadletter in self._deadletters.values()]
+
+        tmpfilename = self._filename + '.tmp'
+        try:
+            with open(tmpfilename, 'w') as file:
+                json.dump(exportlist, file)
+
+            os.replace(tmpfilename, self._filename)
+        except OSError as err:
+            logging.error(f"Cannot write file {self._filename}: {err}")
+            return False
+
+        return True
+
+    # Record a failure of a message. The number of attempts is increased if
+    # the message has failed before.
+
+    def add(self, messageid, errorclass, error, retryable):
+        key = (messageid._folder, messageid._id)
+        with self._lock:
+            deadletter = self._deadletters.get(key)
+            attempts = 1 if deadletter is None else deadletter._attempts + 1
+            self._deadletters[key] = DeadLetter(messageid, errorclass, error,
+                                                retryable, attempts)
+
+    def remove(self, messageid):
+        with self._lock:
+            self._deadletters.pop((messageid._folder, messageid._id), None)
+
+    def __len__(self):
+        return len(self._deadletters)
+
+    # Returns the ids of the failed messages. If retryableonly is set, only
+    # messages with a retryable error are returned.
+
+    def messageIDs(self, retryableonly=False):
+        with self._lock:
+            return [deadletter._messageid
+                    for deadletter in self._deadletters.values()
+                    if not retryableonly or deadletter._retryable]
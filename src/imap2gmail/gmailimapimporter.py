@@ -6,27 +6,115 @@
 import os.path
 import logging
 import re
-import google_auth_httplib2
-import httplib2
+import urllib.parse
 
 from ratelimit import limits, RateLimitException, sleep_and_retry
-from base64 import urlsafe_b64decode, urlsafe_b64encode
 
-from google.auth.transport.requests import Request
-from google.auth.exceptions import GoogleAuthError
-from google.oauth2.credentials import Credentials
+from . import governor
+from . import startupprofile
+from . import tracer
+from .tokenmanager import TokenManager
+from .uploadbody import MESSAGE_CONTENT_TYPE, multipartBody
 
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
+# The Google client libraries take a long time to import. They are imported
+# in the functions that use them, so that runs that do not talk to GMail
+# (such as --logout) do not pay for them.
 
 # If modifying these scopes, delete the file token.json.
 SCOPES = ['https://www.googleapis.com/auth/gmail.modify']
 
 MAX_CALLS_PER_SECOND = 8
 ONE_SECOND = 1
+
+# Messages are sent as media uploads, see uploadbody.py
+UPLOAD_URL = 'https://gmail.googleapis.com/upload/gmail/v1/users/me/'
+
+# GMail API quota units per call, and the per user limit
+QUOTA_UNITS_IMPORT = 25
+QUOTA_UNITS_DRAFT = 10
+QUOTA_UNITS_LABEL = 5
+MAX_QUOTA_UNITS_PER_SECOND = 250
+
+# Reading message headers in bulk. A get costs 5 quota units, so one batch
+# of 50 gets per second stays within the quota.
+LIST_PAGE_SIZE = 500
+GET_BATCH_SIZE = 50
+MAX_BATCHES_PER_SECOND = 1
+MAX_BATCH_ATTEMPTS = 5
 INBOX = 'INBOX'
 
+# Searching for missing Message-IDs. Many are searched for in one query, up
+# to this length.
+LOOKUP_QUERY_LENGTH = 1000
+LOOKUP_SPECIAL_CHARACTERS = ' {}()"'
+RETRYABLE_HTTP_STATUS = (401, 429)
+
+
+# Split Message-IDs in groups that are searched for with one query:
+# {rfc822msgid:a rfc822msgid:b ...}, which is at most LOOKUP_QUERY_LENGTH
+# long. A Message-ID with characters that have a meaning in a query is
+# searched for on its own. Yields (query, Message-IDs) tuples.
+
+def lookupQueries(messageids):
+    group = []
+    terms = []
+    length = 0
+    for messageid in messageids:
+        term = f"rfc822msgid:{normalizeMessageID(messageid)}"
+        if any(char in term for char in LOOKUP_SPECIAL_CHARACTERS):
+            yield term, [messageid]
+            continue
+
+        # The braces and a space per term
+        if terms and length + len(term) + 3 > LOOKUP_QUERY_LENGTH:
+            yield '{' + ' '.join(terms) + '}', group
+            group = []
+            terms = []
+            length = 0
+
+        group.append(messageid)
+        terms.append(term)
+        length += len(term) + 1
+
+    if group:
+        yield '{' + ' '.join(terms) + '}', group
+
+
+# Message-ID without the angle brackets, as GMail searches for it
+def normalizeMessageID(messageid):
+    return messageid.strip().strip('<>')
+
+
+# Error from an import. The error class (such as 'http503' or 'TimeoutError')
+# and whether it is worth retrying are kept with the message.
+class GMailImportError:
+    __slots__ = '_message', '_errorclass', '_retryable'
+
+    def __init__(self, message, errorclass, retryable):
+        self._message = message
+        self._errorclass = errorclass
+        self._retryable = retryable
+
+    # Create an error from an exception. Expired tokens (401), rate limits
+    # (429), server errors (5xx), time outs and network errors are retryable.
+
+    def fromException(description, error):
+        import httplib2
+        from googleapiclient.errors import HttpError
+
+        if isinstance(error, HttpError):
+            status = int(error.resp.status)
+            return GMailImportError(
+                f"{description}: {error}", f"http{status}",
+                status in RETRYABLE_HTTP_STATUS or status >= 500)
+
+        retryable = isinstance(error, (OSError, httplib2.HttpLib2Error))
+        return GMailImportError(f"{description}: {error}",
+                                type(error).__name__, retryable)
+
+    def __str__(self):
+        return self._message
+
 
 # Representation of an GMail label, and its IMAP folder source
 class GMailLabel:
@@ -63,11 +151,17 @@ class GMailLabels:
 class GMailImapImporter:
     __slots__ = '_service', '_labels', '_unreadlabel', \
                 '_starredlabel', '_junklabel', '_draftlabel', \
-                 '_trashlabel', '_inboxlabel', '_creds'
+                 '_trashlabel', '_inboxlabel', '_creds', '_tokenmanager'
     TOKENFILE = 'gmail_token.json'
 
     def __init__(self):
         self._service = None
+        self._tokenmanager = None
+
+    # Stop refreshing the token in the background
+    def stop(self):
+        if self._tokenmanager is not None:
+            self._tokenmanager.stop()
 
     def logout(self):
         try:
@@ -80,16 +174,30 @@ class GMailImapImporter:
         if self._loadCredentials(credentialsfile, reauthenticate) is False:
             return
 
+        from googleapiclient.discovery import build
+        from googleapiclient.errors import HttpError
+        startupprofile.mark("Import GMail API client")
+
+        # Use the discovery document that is bundled with the client
+        # library, instead of fetching or caching it.
         try:
-            self._service = build('gmail', 'v1', credentials=self._creds)
+            self._service = build('gmail', 'v1', credentials=self._creds,
+                                  static_discovery=True,
+                                  cache_discovery=False)
         except HttpError as error:
             # TODO(developer) - Handle errors from gmail API.
             logging.error(f'An error occurred: {error}')
 
-        if self._refreshToken() is False:
+        startupprofile.mark("Build GMail service")
+
+        if self._tokenmanager.refresh() is False:
             logging.critical("Refresh token failed.")
             return False
 
+        startupprofile.mark("Refresh GMail token")
+
+        self._tokenmanager.start()
+
         return self.isOK()
 
     def isOK(self):
@@ -100,6 +208,9 @@ class GMailImapImporter:
     # starred, ...)
 
     def loadLabels(self):
+        from google.auth.exceptions import GoogleAuthError
+        from googleapiclient.errors import HttpError
+
         logging.info("Reading current GMail labels.")
         self._labels = None
 
@@ -160,6 +271,7 @@ class GMailImapImporter:
 
             self._labels._labels.append(newlabel)
 
+        startupprofile.mark("Load GMail labels")
         return True
 
     # Prepare the client for a number of imap folder. Create corresponding
@@ -179,7 +291,7 @@ class GMailImapImporter:
 
             label_obj = {'name': clean_folder}
 
-            if self._refreshToken() is False:
+            if self._tokenmanager.waitForValidToken() is False:
                 logging.critical("Refresh token failed.")
                 return False
 
@@ -200,40 +312,328 @@ class GMailImapImporter:
 
         return True
 
+    # Returns the folders that do not have a corresponding label in GMail,
+    # and would be created by addImapFolders
+
+    def missingLabels(self, folders):
+        return [folder for folder in folders
+                if self._labels.findLabelForImapFolder(
+                    GMailImapImporter._cleanFolderName(folder)) is None]
+
+    # Returns true if messages in the folder are imported as drafts
+    def isDraftFolder(self, folder):
+        label = self._labels.findLabelForImapFolder(
+            GMailImapImporter._cleanFolderName(folder))
+        return label is not None and \
+            label._GMailID == self._draftlabel._GMailID
+
     # Add message to Gmail, with the apropriate labels based on flags and
     # folder. The message is expected to have the FLAGS and RFC822 parts.
-    # Return an error messag or None (success)
+    # Return a GMailImportError or None (success)
 
-    @sleep_and_retry
-    @limits(calls=MAX_CALLS_PER_SECOND, period=ONE_SECOND)
-    def importImapMessage(self, message, folder) -> str | None:
+    def importImapMessage(self, message, folder) -> GMailImportError | None:
         folder = GMailImapImporter._cleanFolderName(folder)
-        flags = message[b'FLAGS']
-        messagelabels = []
 
         # Find label based on folder name
         folderlabel = self._labels.findLabelForImapFolder(folder)
 
-        if self._refreshToken() is False:
-            return "Refresh token failed."
+        with tracer.span('token'):
+            if self._tokenmanager.waitForValidToken() is False:
+                return GMailImportError("Refresh token failed.", 'token',
+                                        True)
 
         # Drafts are handled separately with a separate drafts.create call.
+        # They have no metadata, so the message is the body of the request.
         if folderlabel._GMailID == self._draftlabel._GMailID:
-            message_body = \
-                {'raw': urlsafe_b64encode(message[b'RFC822']).decode()}
-            message = {'message': message_body}
+            governor.throttleUpload(len(message[b'RFC822']))
+
+            with tracer.span('rate limit'):
+                self._waitForRateLimit()
+
+            try:
+                with tracer.span('upload'):
+                    self._upload('drafts', {'uploadType': 'media'},
+                                 message[b'RFC822'], MESSAGE_CONTENT_TYPE)
+            except Exception as error:
+                return GMailImportError.fromException(
+                    "Could not upload draft to GMail", error)
+
+            return None
+
+        messagelabels = self._messageLabels(folderlabel, message[b'FLAGS'])
+
+        with tracer.span('encode'):
+            body, contenttype = multipartBody({'labelIds': messagelabels},
+                                              message[b'RFC822'])
+
+        governor.throttleUpload(len(body))
+
+        with tracer.span('rate limit'):
+            self._waitForRateLimit()
+
+        try:
+            with tracer.span('upload'):
+                self._upload('messages/import',
+                             {'uploadType': 'multipart',
+                              'internalDateSource': 'dateHeader',
+                              'processForCalendar': 'false',
+                              'neverMarkSpam': 'true'},
+                             body, contenttype)
+        except Exception as error:
+            return GMailImportError.fromException(
+                "Could not upload message to GMail", error)
+
+        return None
+
+    # Send a media upload to GMail. body is sent as it is. Raises HttpError
+    # like the calls of the service.
+
+    def _upload(self, path, parameters, body, contenttype):
+        from googleapiclient.http import HttpRequest
+        from googleapiclient.model import JsonModel
+
+        request = HttpRequest(
+            self._createHttp(), JsonModel(data_wrapper=False).response,
+            UPLOAD_URL + path + '?' + urllib.parse.urlencode(parameters),
+            method='POST', body=body,
+            headers={'content-type': contenttype})
+        return request.execute(num_retries=2)
+
+    # If a token does not exists, use credentials file to ask user for
+    # permission and get a token.
+
+    def _loadCredentials(self, credentialsfile, reauthenticate):
+        from google.oauth2.credentials import Credentials
+        startupprofile.mark("Import Google auth")
+
+        self._creds = None
+        if reauthenticate is False and os.path.exists(self.TOKENFILE):
+            self._creds = Credentials.from_authorized_user_file(
+                self.TOKENFILE, SCOPES)
+
+        fromflow = not self._creds
+        if fromflow:
+            from google_auth_oauthlib.flow import InstalledAppFlow
+            try:
+                flow = InstalledAppFlow.from_client_secrets_file(
+                    credentialsfile, SCOPES)
+            except OSError as err:
+                logging.critical(
+                    f"Cannot create secrets from {credentialsfile}: {err}")
+                return False
+
+            try:
+                self._creds = flow.run_local_server(port=0)
+            except Exception as err:
+                logging.critical(f"No valid client created: {err}."
+                                 f"Check if Google credentials are correct.")
+                return False
+
+        if self._creds is None:
+            return False
+
+        self._tokenmanager = TokenManager(self._creds, self.TOKENFILE)
+        if fromflow:
+            self._tokenmanager.writeToken()
+
+        startupprofile.mark("Load GMail credentials")
+        return True
+
+    # Returns the ids of the labels that messages in the folders can get:
+    # the label of each folder, and TRASH and SPAM.
+
+    def labelIdsForFolders(self, folders):
+        labelids = {self._trashlabel._GMailID, self._junklabel._GMailID}
+        for folder in folders:
+            label = self._labels.findLabelForImapFolder(
+                GMailImapImporter._cleanFolderName(folder))
+            if label is not None:
+                labelids.add(label._GMailID)
+
+        return sorted(labelids)
+
+    # Read the Message-ID header and the labels of all messages that have any
+    # of the labels. The ids are listed page by page, and the headers are
+    # read with batched gets. found(gmailid, messageid, labelids) is called
+    # once per message. Returns False on error.
+
+    def retrieveMessageHeaders(self, labelids, found):
+        from googleapiclient.errors import HttpError
+
+        seen = set()
+        for labelid in labelids:
+            logging.info(f"Listing GMail messages with label {labelid}.")
+            pagetoken = None
+            while True:
+                if self._tokenmanager.waitForValidToken() is False:
+                    logging.error("Refresh token failed.")
+                    return False
+
+                self._waitForRateLimit()
+                try:
+                    result = self._service.users().messages().list(
+                        userId='me', labelIds=[labelid],
+                        includeSpamTrash=True, maxResults=LIST_PAGE_SIZE,
+                        pageToken=pagetoken,
+                        fields='messages/id,nextPageToken').execute(
+                            num_retries=2, http=self._createHttp())
+                except (HttpError, OSError) as error:
+                    logging.error(f"Cannot list messages with label "
+                                  f"{labelid}: {error}")
+                    return False
+
+                gmailids = [message['id']
+                            for message in result.get('messages', [])
+                            if message['id'] not in seen]
+                seen.update(gmailids)
+
+                if self._getMessageHeaders(gmailids, found) is False:
+                    return False
+
+                pagetoken = result.get('nextPageToken')
+                if not pagetoken:
+                    break
+
+        return True
+
+    # Search all mail, including spam and trash, for messages with the
+    # Message-IDs, and read their headers. found is called for each message
+    # as in retrieveMessageHeaders. The Message-IDs are searched for with one
+    # query per group, see lookupQueries. Returns the Message-IDs that are
+    # not found. Message-IDs of a query that failed are not returned.
+
+    def lookupMessageIDs(self, messageids, found):
+        absent = set()
+        for query, group in lookupQueries(messageids):
+            gmailids = self._searchMessages(query)
+            if gmailids is None:
+                continue
+
+            foundids = set()
+
+            def foundMessage(gmailid, messageid, labelids):
+                if messageid is not None:
+                    foundids.add(normalizeMessageID(messageid))
+                found(gmailid, messageid, labelids)
+
+            if self._getMessageHeaders(gmailids, foundMessage) is False:
+                continue
+
+            absent.update(messageid for messageid in group
+                          if normalizeMessageID(messageid) not in foundids)
+
+        return absent
+
+    # Returns the ids of all messages that match the query, including spam
+    # and trash, or None on error
+
+    def _searchMessages(self, query):
+        from googleapiclient.errors import HttpError
+
+        gmailids = []
+        pagetoken = None
+        while True:
+            if self._tokenmanager.waitForValidToken() is False:
+                logging.error("Refresh token failed.")
+                return None
+
+            self._waitForRateLimit()
             try:
-                http = google_auth_httplib2.AuthorizedHttp(
-                    self._creds, http=httplib2.Http())
-                self._service.users().drafts().create(
-                    userId="me",
-                    body=message,
-                    ).execute(num_retries=2, http=http)
+                result = self._service.users().messages().list(
+                    userId='me', q=query, includeSpamTrash=True,
+                    maxResults=LIST_PAGE_SIZE, pageToken=pagetoken,
+                    fields='messages/id,nextPageToken').execute(
+                        num_retries=2, http=self._createHttp())
+            except (HttpError, OSError) as error:
+                logging.warning(f"Cannot search for {query}: {error}")
+                return None
+
+            gmailids.extend(message['id']
+                            for message in result.get('messages', []))
+            pagetoken = result.get('nextPageToken')
+            if not pagetoken:
+                return gmailids
+
+    # Get the headers of messages in batches. Gets that fail in a batch (for
+    # example because of rate limits) are tried again in the next batch.
+    # Messages that cannot be read (such as a message that is deleted since
+    # it was listed) are skipped.
+
+    def _getMessageHeaders(self, gmailids, found):
+        pending = list(gmailids)
+        attempts = 0
+        while pending:
+            attempts += 1
+            if attempts > MAX_BATCH_ATTEMPTS * \
+                    (len(gmailids) // GET_BATCH_SIZE + 1):
+                logging.error(f"Cannot read headers of {len(pending)} "
+                              f"messages.")
+                return False
+
+            batchids = pending[:GET_BATCH_SIZE]
+            pending = pending[GET_BATCH_SIZE:]
+            failed = []
+
+            def callback(requestid, response, exception):
+                if exception is not None:
+                    error = GMailImportError.fromException(
+                        f"Cannot read headers of message {requestid}",
+                        exception)
+                    if error._retryable:
+                        failed.append(requestid)
+                    else:
+                        logging.warning(str(error))
+                    return
+
+                messageid = None
+                for header in response.get('payload', {}).get('headers', []):
+                    if header['name'].lower() == 'message-id':
+                        messageid = header['value']
+
+                found(response['id'], messageid,
+                      response.get('labelIds', []))
+
+            if self._tokenmanager.waitForValidToken() is False:
+                logging.error("Refresh token failed.")
+                return False
+
+            self._waitForBatchRateLimit()
+            batch = self._service.new_batch_http_request(callback=callback)
+            for gmailid in batchids:
+                batch.add(self._service.users().messages().get(
+                    userId='me', id=gmailid, format='metadata',
+                    metadataHeaders=['Message-ID'],
+                    fields='id,labelIds,payload/headers'),
+                    request_id=gmailid)
+
+            try:
+                batch.execute(http=self._createHttp())
             except Exception as error:
-                return f"Could not upload draft to GMail: {error}"
+                logging.warning(f"Batch of message headers failed: {error}")
+                failed = batchids
+
+            pending.extend(failed)
+
+        return True
 
+    # Returns the ids of the labels that a message with the IMAP flags in the
+    # folder gets in GMail. Messages in the drafts folder only get the draft
+    # label. Returns None if the folder has no label.
+
+    def messageLabels(self, flags, folder):
+        folderlabel = self._labels.findLabelForImapFolder(
+            GMailImapImporter._cleanFolderName(folder))
+        if folderlabel is None:
             return None
 
+        if folderlabel._GMailID == self._draftlabel._GMailID:
+            return [self._draftlabel._GMailID]
+
+        return self._messageLabels(folderlabel, flags)
+
+    def _messageLabels(self, folderlabel, flags):
+        messagelabels = []
+
         # Search for flagged and seen flags, and set labels accordingly
         seen = False
         flagged = False
@@ -273,76 +673,30 @@ class GMailImapImporter:
         if flagged is True:
             messagelabels.append(self._starredlabel._GMailID)
 
-        message_obj = {'raw': urlsafe_b64encode(message[b'RFC822']).decode(),
-                       'labelIds': messagelabels}
-
-        try:
-            http = google_auth_httplib2.AuthorizedHttp(
-                self._creds, http=httplib2.Http())
-            self._service.users().messages().import_(
-                    userId="me",
-                    body=message_obj,
-                    internalDateSource='dateHeader',
-                    processForCalendar=False,
-                    neverMarkSpam=True,
-                    ).execute(num_retries=2, http=http)
-        except Exception as error:
-            return f"Could not upload message to GMail: {error}"
-
-        return None
-
-    # If a token does not exists, use credentials file to ask user for
-    # permission and get a token.
+        return messagelabels
 
-    def _loadCredentials(self, credentialsfile, reauthenticate):
-        self._creds = None
-        if reauthenticate is False and os.path.exists(self.TOKENFILE):
-            self._creds = Credentials.from_authorized_user_file(
-                self.TOKENFILE, SCOPES)
+    # Returns when a call to GMail is allowed by the rate limit. Sleeps if
+    # the limit is reached.
 
-        if not self._creds:
-            try:
-                flow = InstalledAppFlow.from_client_secrets_file(
-                    credentialsfile, SCOPES)
-            except OSError as err:
-                logging.critical(
-                    f"Cannot create secrets from {credentialsfile}: {err}")
-                return False
-
-            try:
-                self._creds = flow.run_local_server(port=0)
-            except Exception as err:
-                logging.critical(f"No valid client created: {err}."
-                                 f"Check if Google credentials are correct.")
-                return False
-
-            self._writeToken()
-
-        return self._creds is not None
-
-    # Refresh the token
-
-    def _refreshToken(self):
-        if self._creds and self._creds.expired and self._creds.refresh_token:
-            try:
-                self._creds.refresh(Request())
-            except Exception as error:
-                logging.error(f"Could not upload message to GMail: {error}")
-                return False
-
-            self._writeToken()
+    @sleep_and_retry
+    @limits(calls=MAX_CALLS_PER_SECOND, period=ONE_SECOND)
+    def _waitForRateLimit(self):
+        pass
 
-        return self._creds and self._creds.valid
+    @sleep_and_retry
+    @limits(calls=MAX_BATCHES_PER_SECOND, period=ONE_SECOND)
+    def _waitForBatchRateLimit(self):
+        pass
 
-    # Save the credentials for the next run
+    # Create a http object for one call. The token is kept valid by the
+    # TokenManager, so the call itself should never refresh it.
 
-    def _writeToken(self):
+    def _createHttp(self):
+        import google_auth_httplib2
+        import httplib2
 
-        with open(self.TOKENFILE, 'w') as token:
-            try:
-                token.write(self._creds.to_json())
-            except OSError as err:
-                logging.error(f"Cannot write file {self.TOKENFILE}: {err}")
+        return google_auth_httplib2.AuthorizedHttp(
+            self._creds, http=httplib2.Http(), refresh_status_codes=())
 
     # Replace the '.' with a forward slash '/' in folder name
     # Remove whitespaces at the end or beginning
@@ -0,0 +1,443 @@
+#
+# Copyright © 2022 Tingdahl ICT Management
+# Licenced under the MIT licence, see license.md
+#
+
+import datetime
+import json
+import logging
+import os
+import signal
+import threading
+import time
+from . import tracer
+
+# Limits how much of the network a migration uses, so it can run on a shared
+# link during business hours.
+#
+# The IMAP download and the GMail upload each have a limit in bytes per
+# second, and the number of messages that are processed at the same time can
+# be limited below the number of threads. ImapReader calls
+# throttleDownload() with the size of a message before it loads it, and
+# corrects the booking with the size it got afterwards. The size is known
+# from the discovery; when it is not, the message is only counted after it
+# is loaded. GMailImapImporter calls throttleUpload() before each upload.
+# They sleep as long as needed to keep the average rate below the limit. The
+# processing threads hold a slot() while they process a message.
+#
+# The discovery and the fetches of sizes, dates and Message-IDs (for --plan
+# and --verify) are not limited, as they transfer a few hundred bytes per
+# message only.
+#
+# The limits are given with --download_rate, --upload_rate and
+# --active_threads, and can be changed during the run with a control file
+# (--governor_file), which is read again when it changes or on SIGHUP:
+#
+#    {
+#        "download_rate": "8M",
+#        "upload_rate": "4M",
+#        "threads": 16,
+#        "schedule": [
+#            {"from": "08:00", "to": "18:00",
+#             "download_rate": "1M", "upload_rate": "512k", "threads": 2}
+#        ]
+#    }
+#
+# Rates are in bytes per second, with an optional k, M or G suffix, and null
+# is no limit. The first entry of the schedule that contains the time of day
+# overrides the limits outside the schedule; an entry may wrap past
+# midnight. Without any limit, the functions return immediately.
+
+# Check the control file and the schedule this often
+CONTROL_POLL_SECONDS = 5
+
+# Time that an idle link may catch up on, so short pauses do not lower the
+# average rate
+BURST_SECONDS = 1
+
+RATE_SUFFIXES = {'k': 1024, 'm': 1024 * 1024, 'g': 1024 * 1024 * 1024}
+
+SETTING_KEYS = ('download_rate', 'upload_rate', 'threads')
+
+
+# Keeps the average number of bytes per second below a rate. The rate can be
+# changed at any time; None is no limit.
+#
+# The bytes that are booked and the bytes that the rate allows are counted
+# since the start. A thread that books bytes waits until the allowed bytes
+# reach the end of its booking. When the rate changes, the waiting threads
+# are woken up, and wait again for the time that their booking takes at the
+# new rate.
+
+class ByteRate:
+    __slots__ = '_condition', '_rate', '_booked', '_allowed', '_last'
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._rate = None
+        self._booked = 0
+        self._allowed = 0
+        self._last = time.monotonic()
+
+    def setRate(self, rate):
+        with self._condition:
+            self._refill()
+            if self._rate is None:
+                self._allowed = self._booked
+
+            self._rate = rate
+            self._condition.notify_all()
+
+    # Book nbytes on the rate, and wait until they may be transferred. A
+    # negative nbytes gives back bytes that were booked but not transferred.
+    # Returns the number of seconds waited.
+
+    def take(self, nbytes):
+        with self._condition:
+            self._refill()
+            self._booked += nbytes
+            end = self._booked
+            if self._rate is None:
+                self._allowed = self._booked
+                return 0
+
+            if self._allowed >= end:
+                return 0
+
+            with tracer.span('throttle'):
+                start = time.monotonic()
+                while self._rate is not None and self._allowed < end:
+                    self._condition.wait((end - self._allowed) / self._rate)
+                    self._refill()
+
+                return time.monotonic() - start
+
+    # Add the bytes that the rate allowed since the last call. An idle link
+    # may catch up on BURST_SECONDS only.
+
+    def _refill(self):
+        now = time.monotonic()
+        if self._rate is not None:
+            self._allowed = min(
+                self._allowed + (now - self._last) * self._rate,
+                self._booked + BURST_SECONDS * self._rate)
+
+        self._last = now
+
+
+# Limits the number of threads that process a message at the same time. The
+# limit can be changed at any time; None is no limit.
+
+class ThreadGate:
+    __slots__ = '_condition', '_limit', '_active'
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._limit = None
+        self._active = 0
+
+    def setLimit(self, limit):
+        with self._condition:
+            self._limit = limit
+            self._condition.notify_all()
+
+    def __enter__(self):
+        with self._condition:
+            while self._limit is not None and self._active >= self._limit:
+                self._condition.wait()
+
+            self._active += 1
+
+        return self
+
+    def __exit__(self, *args):
+        with self._condition:
+            self._active -= 1
+            self._condition.notify()
+
+        return False
+
+
+class _NoSlot:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_NOSLOT = _NoSlot()
+
+_enabled = False
+_defaults = {}
+_controlfile = None
+_controlmtime = None
+_control = {}
+_current = None
+_download = ByteRate()
+_upload = ByteRate()
+_gate = ThreadGate()
+_wakeup = threading.Event()
+_stop = threading.Event()
+_thread = None
+_previoushandler = None
+
+
+# Returns a rate in bytes per second from a number or a string such as "512k"
+# or "2M". Returns None for no limit, and raises ValueError if it cannot be
+# parsed.
+
+def parseRate(value):
+    if value is None:
+        return None
+
+    if isinstance(value, (int, float)):
+        rate = float(value)
+    else:
+        text = str(value).strip().lower()
+        if text in ('', 'none', 'unlimited'):
+            return None
+
+        multiplier = RATE_SUFFIXES.get(text[-1], 1)
+        if text[-1] in RATE_SUFFIXES:
+            text = text[:-1]
+
+        rate = float(text) * multiplier
+
+    if rate < 0:
+        raise ValueError(f"Negative rate {value}")
+
+    return rate or None
+
+
+def parseTime(value):
+    return datetime.datetime.strptime(value, '%H:%M').time()
+
+
+# Returns true if now is in the period from start to end, which may wrap past
+# midnight
+
+def isInPeriod(now, start, end):
+    if start <= end:
+        return start <= now < end
+
+    return now >= start or now < end
+
+
+# Set the limits that apply when the control file does not give them, and
+# the control file. Returns False if a limit cannot be parsed.
+
+def configure(downloadrate, uploadrate, threads, controlfile):
+    global _enabled, _defaults, _controlfile
+    try:
+        _defaults = {'download_rate': parseRate(downloadrate),
+                     'upload_rate': parseRate(uploadrate),
+                     'threads': threads}
+    except ValueError as err:
+        logging.error(f"Invalid rate: {err}")
+        return False
+
+    _controlfile = controlfile
+    _enabled = controlfile is not None or \
+        any(value is not None for value in _defaults.values())
+
+    if _enabled and _loadControlFile() is False:
+        return False
+
+    if _enabled:
+        _apply()
+
+    return True
+
+
+def isEnabled():
+    return _enabled
+
+
+# Returns the limits that apply now, as a dict with download_rate,
+# upload_rate and threads. None is no limit.
+
+def currentLimits():
+    if not _enabled:
+        return {key: None for key in SETTING_KEYS}
+
+    settings = _currentSettings()
+    return {key: settings[key] for key in SETTING_KEYS}
+
+
+# Start checking the control file and the schedule in the background. On
+# SIGHUP, the control file is read again immediately.
+
+def start():
+    global _thread, _previoushandler
+    if not _enabled or _thread is not None:
+        return
+
+    if hasattr(signal, 'SIGHUP') and \
+       threading.current_thread() is threading.main_thread():
+        _previoushandler = signal.signal(signal.SIGHUP, _onSignal)
+
+    _stop.clear()
+    _thread = threading.Thread(target=_controlThreadFunction, daemon=True,
+                               name="governor")
+    _thread.start()
+
+
+def stop():
+    global _thread, _previoushandler
+    if _thread is None:
+        return
+
+    _stop.set()
+    _wakeup.set()
+    _thread.join()
+    _thread = None
+
+    if _previoushandler is not None:
+        signal.signal(signal.SIGHUP, _previoushandler)
+        _previoushandler = None
+
+
+# Wait before downloading nbytes, to keep below the download rate. A
+# negative nbytes corrects a previous call that booked too much.
+
+def throttleDownload(nbytes):
+    if _enabled:
+        _download.take(nbytes)
+
+
+# Wait before uploading nbytes, to keep below the upload rate
+def throttleUpload(nbytes):
+    if _enabled:
+        _upload.take(nbytes)
+
+
+# Returns a context manager that is held while a message is processed
+def slot():
+    if not _enabled:
+        return _NOSLOT
+
+    return _gate
+
+
+def _onSignal(signum, frame):
+    global _controlmtime
+    _controlmtime = None
+    _wakeup.set()
+
+
+# Read the control file if it has changed since it was read. A control file
+# that cannot be read leaves the limits as they are.
+
+def _loadControlFile():
+    global _control, _controlmtime
+    if _controlfile is None:
+        return True
+
+    try:
+        mtime = os.stat(_controlfile).st_mtime
+    except OSError:
+        if _controlmtime is not None:
+            logging.warning(f"Control file {_controlfile} is removed. "
+                            f"Using the limits of the command line.")
+            _control = {}
+            _controlmtime = None
+        return True
+
+    if mtime == _controlmtime:
+        return True
+
+    # The file is not read again until it changes, also if it has errors
+    _controlmtime = mtime
+    try:
+        with open(_controlfile) as file:
+            control = json.load(file)
+
+        control = _parseSettings(control)
+        control['schedule'] = [
+            (parseTime(entry['from']), parseTime(entry['to']),
+             _parseSettings(entry))
+            for entry in control.get('schedule', [])]
+    except (OSError, ValueError, KeyError, TypeError) as err:
+        logging.error(f"Cannot read control file {_controlfile}: {err}")
+        return False
+
+    _control = control
+    logging.info(f"Read control file {_controlfile}.")
+    return True
+
+
+# Returns a copy of the settings, with the rates in bytes per second. Keys
+# that are not given are left out.
+
+def _parseSettings(settings):
+    result = dict(settings)
+    for key in ('download_rate', 'upload_rate'):
+        if key in result:
+            result[key] = parseRate(result[key])
+
+    if result.get('threads') is not None:
+        result['threads'] = int(result['threads'])
+        if result['threads'] < 1:
+            raise ValueError("threads must be at least 1")
+
+    return result
+
+
+# Returns the limits that apply now: the first schedule entry that contains
+# the time of day, then the control file, then the command line.
+
+def _currentSettings():
+    settings = {key: _defaults.get(key) for key in SETTING_KEYS}
+    settings['period'] = None
+    for key in SETTING_KEYS:
+        if key in _control:
+            settings[key] = _control[key]
+
+    now = datetime.datetime.now().time()
+    for start, end, entry in _control.get('schedule', []):
+        if isInPeriod(now, start, end):
+            for key in SETTING_KEYS:
+                if key in entry:
+                    settings[key] = entry[key]
+
+            settings['period'] = f"{start:%H:%M}-{end:%H:%M}"
+            break
+
+    return settings
+
+
+# Apply the limits that apply now, if they have changed
+def _apply():
+    global _current
+    settings = _currentSettings()
+    if settings == _current:
+        return
+
+    _current = settings
+    _download.setRate(settings['download_rate'])
+    _upload.setRate(settings['upload_rate'])
+    _gate.setLimit(settings['threads'])
+
+    period = f" (schedule {settings['period']})" \
+        if settings['period'] else ""
+    logging.info(f"Limits: download {describeRate(settings['download_rate'])}"
+                 f", upload {describeRate(settings['upload_rate'])}, "
+                 f"{settings['threads'] or 'all'} threads{period}.")
+
+
+def describeRate(rate):
+    if rate is None:
+        return "unlimited"
+
+    return f"{rate / 1024:.0f} kB/s"
+
+
+def _controlThreadFunction():
+    while not _stop.is_set():
+        _wakeup.wait(CONTROL_POLL_SECONDS)
+        _wakeup.clear()
+        _loadControlFile()
+        _apply()
@@ -4,14 +4,24 @@
 #
 
 import datetime
+import json
 import multiprocessing
 import os
 import sys
-from .imapreader import ImapCredentials
+from . import governor
+from . import startupprofile
+from . import tracer
+from .imapreader import ImapCredentials, ImapReader
 import logging
 import argparse
 from .imap2gmailprocessor import Imap2GMailProcessor
+from .deadletters import DeadLetterList
+from .planner import logPlan
+from .verifier import Verifier, logReport
 from .gmailimapimporter import GMailImapImporter
+from .scheduler import PRIORITY_NEWEST, PRIORITY_SIZE
+from .localreader import MaildirReader, MboxArchive, MboxReader
+from .spool import MessageSpool, SpoolReader
 
 CURRENT_DIR = './'
 
@@ -46,7 +56,56 @@ def checkFileAccess(filename, read):
     return True
 
 
+# Returns the dead letter file of the spool fetch phase:
+# imap2gmail_failed.json becomes imap2gmail_failed_spool.json
+
+def spoolDeadLetterFile(filename):
+    root, extension = os.path.splitext(filename)
+    return f"{root}_spool{extension}"
+
+
+# Returns a function that creates a reader for the source of the messages
+# (IMAP server, Maildir or mbox), or None on error.
+
+def createSourceFactory(args, parser):
+    if args.maildir:
+        return lambda: MaildirReader(args.maildir)
+
+    if args.mbox:
+        archive = MboxArchive(args.mbox)
+        if archive.isOK() is False:
+            logging.error(f"No mbox files found in {args.mbox}")
+            return None
+
+        return lambda: MboxReader(archive)
+
+    # Parse imap creds
+    imapcredentials = ImapCredentials()
+
+    if args.imap_credentials_file:
+        imapcredentials.loadJsonFile(args.imap_credentials_file)
+    else:
+        if args.imap_host is None or \
+                args.imap_user is None or \
+                args.imap_password is None:
+            print("You most specify either imap_credentials file or imap_host,"
+                  " imap_user, and imap_password")
+            parser.print_help()
+            return None
+
+        imapcredentials._host = args.imap_host
+        imapcredentials._user = args.imap_user
+        imapcredentials._password = args.imap_password
+
+    if imapcredentials.isOK() is False:
+        logging.error("IMAP Credentials not read")
+        return None
+
+    return lambda: ImapReader(imapcredentials)
+
+
 def imap2gmail():
+    startupprofile.mark("Import modules")
     logging.basicConfig(level=logging.INFO)
 
     parser = argparse.ArgumentParser()
@@ -66,17 +125,89 @@ def imap2gmail():
     imapcligroup.add_argument("--imap_user")
     imapcligroup.add_argument("--imap_password")
 
+    # Local archives instead of an IMAP server
+    imapgroup.add_argument("--maildir",
+                           help="Read messages from a Maildir tree instead "
+                           "of an IMAP server.")
+    imapgroup.add_argument("--mbox",
+                           help="Read messages from an mbox file, or a "
+                           "directory of mbox files, instead of an IMAP "
+                           "server.")
+
     # Cache file
     parser.add_argument("--cache_file",
                         default="./imap2gmail_cache.json",
                         help="File where a list of completed e-mails "
                         "will be kept")
 
+    # Failed messages
+    parser.add_argument("--dead_letter_file",
+                        default="./imap2gmail_failed.json",
+                        help="File where messages that could not be "
+                        "imported are kept, with the error and number of "
+                        "attempts.")
+    parser.add_argument("--retry_failed", action='store_const', const=True,
+                        help="Only retry the messages in the "
+                        "dead_letter_file.")
+
+    # Tracing
+    parser.add_argument("--trace",
+                        help="Record the time of each stage of each message, "
+                        "and write it to this file as a Chrome trace "
+                        "(chrome://tracing or ui.perfetto.dev). A summary "
+                        "is logged at the end of the run.")
+
+    # Plan
+    parser.add_argument("--plan", action='store_const', const=True,
+                        help="Do not import anything. Discover the messages "
+                        "and print the number of bytes, API calls, quota "
+                        "units and the expected time as JSON.")
+
+    # Verify
+    parser.add_argument("--verify", action='store_const', const=True,
+                        help="Do not import anything. Compare the messages "
+                        "in the source with GMail by Message-ID, and print "
+                        "the missing, duplicated and mislabeled messages as "
+                        "JSON. Missing messages are added to the "
+                        "dead_letter_file, and imported by --retry_failed.")
+    parser.add_argument("--verify_index",
+                        default="./imap2gmail_verify.sqlite",
+                        help="File where --verify keeps its index of "
+                        "messages.")
+
+    # Spool
+    parser.add_argument("--spool_dir",
+                        help="Directory where messages are spooled in "
+                        "Maildir format between fetching them from IMAP "
+                        "and uploading them to GMail.")
+    parser.add_argument("--spool_mode", choices=['fetch', 'upload', 'both'],
+                        default='both',
+                        help="With --spool_dir: only fetch from IMAP into "
+                        "the spool, only upload the spool to GMail, or "
+                        "both. Default is both.")
+
     # MT
     parser.add_argument("--max_threads",
                         help="Maximum number of threads. "
                         "Default is 16 threads.")
 
+    # Bandwidth
+    parser.add_argument("--download_rate",
+                        help="Maximum bytes per second downloaded from the "
+                        "IMAP server, such as 512k or 2M. Applies to the "
+                        "messages; the discovery of sizes, dates and "
+                        "Message-IDs is not limited. Default is no limit.")
+    parser.add_argument("--upload_rate",
+                        help="Maximum bytes per second uploaded to GMail, "
+                        "such as 512k or 2M. Default is no limit.")
+    parser.add_argument("--active_threads", type=int,
+                        help="Maximum number of threads that process a "
+                        "message at the same time. Default is all threads.")
+    parser.add_argument("--governor_file",
+                        help="JSON file with the rates, the number of "
+                        "active threads and a time of day schedule. The "
+                        "file is read again when it changes, or on SIGHUP.")
+
     parser.add_argument("--include_deleted", action='store_const', const=True,
                         help="Should messaged marked as deleted be included.")
 
@@ -88,6 +219,23 @@ def imap2gmail():
     parser.add_argument("--reauthenticate", action='store_const', const=True,
                         help="Force new authentification by Google.")
 
+    parser.add_argument("--profile_startup", action='store_const',
+                        const=True,
+                        help="Report where the time goes before the "
+                        "processing starts. With --plan or --verify, the "
+                        "report includes the discovery or verification, and "
+                        "with --login the login.")
+
+    # Order of the messages
+    parser.add_argument("--priority", choices=[PRIORITY_SIZE, PRIORITY_NEWEST],
+                        default=PRIORITY_SIZE,
+                        help="Process the largest messages first, or the "
+                        "newest messages of all folders first, in date "
+                        "windows. Default is size.")
+    parser.add_argument("--window_days", type=int,
+                        help="With --priority newest: number of days in a "
+                        "date window. Default is 30 days.")
+
     # Date limits
     parser.add_argument('--start_date',
                         type=lambda s: datetime.datetime.strptime(s,
@@ -107,6 +255,10 @@ def imap2gmail():
         parser.print_help()
         return False
 
+    if args.profile_startup:
+        startupprofile.enable()
+        startupprofile.mark("Parse arguments")
+
     # Check file permissions
     permissionError = False
     if os.access(CURRENT_DIR, os.W_OK) is False:
@@ -114,8 +266,18 @@ def imap2gmail():
         permissionError = True
 
     if checkFileAccess(args.imap_credentials_file, True) is False or \
+       checkFileAccess(args.maildir, True) is False or \
+       checkFileAccess(args.mbox, True) is False or \
        checkFileAccess(args.google_credentials, True) is False or \
-       checkFileAccess(args.cache_file, False) is False:
+       checkFileAccess(args.cache_file, False) is False or \
+       checkFileAccess(args.dead_letter_file, False) is False or \
+       (args.spool_dir is not None and
+        checkFileAccess(spoolDeadLetterFile(args.dead_letter_file),
+                        False) is False) or \
+       checkFileAccess(args.trace, False) is False or \
+       checkFileAccess(args.verify_index, False) is False or \
+       checkFileAccess(args.governor_file, True) is False or \
+       checkFileAccess(args.spool_dir, args.spool_mode == 'upload') is False:
         permissionError = True
 
     if permissionError:
@@ -130,43 +292,64 @@ def imap2gmail():
         logging.error("Both login and logout given. Select one ore the other")
         return False
 
+    fetchspool = args.spool_dir is not None and args.spool_mode != 'upload'
+    uploadspool = args.spool_dir is not None and args.spool_mode != 'fetch'
+    readsource = args.spool_dir is None or fetchspool
+    upload = args.spool_dir is None or uploadspool
+
+    if args.active_threads is not None and args.active_threads < 1:
+        logging.error("active_threads must be at least 1")
+        return False
+
+    if governor.configure(args.download_rate, args.upload_rate,
+                          args.active_threads, args.governor_file) is False:
+        return False
+
+    if args.window_days is not None and args.window_days < 1:
+        logging.error("window_days must be at least 1")
+        return False
+
+    if args.plan and args.verify:
+        logging.error("Both plan and verify given. Select one or the other")
+        return False
+
+    # A plan or verification is made from the source, or from the spool if
+    # only the spool is uploaded
+    if args.plan or args.verify:
+        fetchspool = False
+        uploadspool = args.spool_dir is not None and \
+            args.spool_mode == 'upload'
+        readsource = not uploadspool
+        upload = True
+
     gmailclient = GMailImapImporter()
 
     if args.logout:
         gmailclient.logout()
         return True
 
-    if gmailclient.login(args.google_credentials,
+    if (upload or args.login) and \
+       gmailclient.login(args.google_credentials,
                          args.reauthenticate is not None) is False:
         logging.error("Cannot login to GMail")
         return False
 
     if args.login:
         logging.info("Logged into GMail")
+        startupprofile.report()
         return True
 
-    # Parse imap creds
-    imapcredentials = ImapCredentials()
+    # The trace file is created after the checks and --login/--logout, so a
+    # run that stops there keeps an existing trace
+    if args.trace and tracer.enable(args.trace) is False:
+        return False
 
-    if args.imap_credentials_file:
-        imapcredentials.loadJsonFile(args.imap_credentials_file)
-    else:
-        if args.imap_host is None or \
-                args.imap_user is None or \
-                args.imap_password is None:
-            print("You most specify either imap_credentials file or imap_host,"
-                  " imap_user, and imap_password")
-            parser.print_help()
+    sourcefactory = None
+    if readsource:
+        sourcefactory = createSourceFactory(args, parser)
+        if sourcefactory is None:
             return False
 
-        imapcredentials._host = args.imap_host
-        imapcredentials._user = args.imap_user
-        imapcredentials._password = args.imap_password
-
-    if imapcredentials.isOK() is False:
-        logging.error("IMAP Credentials not read")
-        return False
-
     maxnrthreads = 16
     if args.max_threads:
         maxnrthreads = int(args.max_threads)
@@ -174,22 +357,128 @@ def imap2gmail():
     nrthreads = min(multiprocessing.cpu_count()*2, maxnrthreads)
     nrthreads = max(nrthreads, 1)
 
-    processor = Imap2GMailProcessor(imapcredentials, gmailclient, nrthreads,
+    # Fetch all messages into the spool, without touching GMail. Messages
+    # that cannot be fetched or spooled are kept in a dead letter file of
+    # their own, as they are retried from the source and not from the spool.
+    if fetchspool:
+        logging.info(f"Fetching messages into spool {args.spool_dir}.")
+        spooldeadletters = DeadLetterList(
+            spoolDeadLetterFile(args.dead_letter_file))
+        if spooldeadletters.loadJsonFile() is False:
+            return False
+
+        processor = Imap2GMailProcessor(
+            sourcefactory, None, nrthreads,
+            args.start_date, args.before_date, args.include_deleted,
+            None, MessageSpool(args.spool_dir), spooldeadletters,
+            args.priority, args.window_days)
+
+        if runProcessor(processor, args.retry_failed is not None) is False:
+            return False
+
+    if not upload:
+        return True
+
+    if uploadspool:
+        logging.info(f"Uploading messages from spool {args.spool_dir}.")
+        readerfactory = lambda: SpoolReader(args.spool_dir)  # noqa: E731
+    else:
+        readerfactory = sourcefactory
+
+    if args.plan:
+        processor = Imap2GMailProcessor(readerfactory, gmailclient, nrthreads,
+                                        args.start_date, args.before_date,
+                                        args.include_deleted,
+                                        args.cache_file)
+        return runPlanner(processor, readsource and args.maildir is None and
+                          args.mbox is None)
+
+    deadletters = DeadLetterList(args.dead_letter_file)
+    if deadletters.loadJsonFile() is False:
+        return False
+
+    if args.verify:
+        processor = Imap2GMailProcessor(readerfactory, gmailclient, nrthreads,
+                                        args.start_date, args.before_date,
+                                        args.include_deleted,
+                                        args.cache_file, None, deadletters)
+        return runVerifier(processor, Verifier(args.verify_index))
+
+    processor = Imap2GMailProcessor(readerfactory, gmailclient, nrthreads,
                                     args.start_date, args.before_date,
                                     args.include_deleted,
-                                    args.cache_file)
+                                    args.cache_file, None, deadletters,
+                                    args.priority, args.window_days)
 
+    return runProcessor(processor, args.retry_failed is not None, gmailclient)
+
+
+# Discover all messages and print the projection of the migration as JSON.
+# download is true if the messages are downloaded from an IMAP server.
+
+def runPlanner(processor, download):
     if processor.isOK() is False:
         return False
 
-    if processor.discoverMessages() is False:
+    plan = processor.plan(download)
+    startupprofile.mark("Discover messages")
+    startupprofile.report()
+    if plan is None:
+        return False
+
+    logPlan(plan)
+    print(json.dumps(plan, indent=2))
+    return True
+
+
+# Compare the source with GMail and print the report as JSON
+
+def runVerifier(processor, verifier):
+    if processor.isOK() is False:
         return False
 
-    processor.process()
+    report = processor.verify(verifier)
+    startupprofile.mark("Verify messages")
+    startupprofile.report()
+    if report is None:
+        return False
 
+    logReport(report)
+    print(json.dumps(report, indent=2))
     return True
 
 
+# Discover and process all messages, or only the ones that failed before.
+# The background token refresh of gmailclient, if given, is stopped at the
+# end.
+
+def runProcessor(processor, retryfailed=False, gmailclient=None):
+    if processor.isOK() is False:
+        return False
+
+    if retryfailed:
+        if processor.discoverFailedMessages() is False:
+            return False
+    elif processor.discoverMessages() is False:
+        return False
+
+    startupprofile.mark("Discover messages")
+    startupprofile.report()
+
+    governor.start()
+    try:
+        result = processor.process()
+    finally:
+        governor.stop()
+        if gmailclient is not None:
+            gmailclient.stop()
+
+    tracer.writeTrace()
+    tracer.logSummary()
+
+    return result
+
+
 if __name__ == "__main__":
     if imap2gmail() is True:
         sys.exit(0)
@@ -4,10 +4,21 @@
 # 
 
 import queue
+import signal
 import threading
-from .imapreader import ImapMessageID,ImapMessageIDList,ImapReader
+from . import governor
+from . import startupprofile
+from . import tracer
+from .cachewriter import CacheWriter
+from .deadletters import FETCH_ERROR, MISSING_ERROR, SPOOL_ERROR
+from .planner import createPlan
+from .scheduler import PRIORITY_SIZE, MessageScheduler
+from .imapreader import ImapMessageID,ImapMessageIDList
 import logging
 
+RETRY_PASSES = 3
+RETRY_BACKOFF_SECONDS = 30
+
 # Reads data from an IMAP server and imports them into GMail. IMAP folders
 # becomes GMail labels.
 # There are two stages in the processing
@@ -17,74 +28,105 @@ import logging
 #    criteria. All messages in from all directories are added to the messagequeue.
 #
 # 2. processing
-#    The queue is processed from a number of threads. Each message is checked if it is
+#    The queue is ordered by the MessageScheduler, largest messages first or
+#    newest date window first, and processed from a number of threads. Each message is checked if it is
 #    present in the cache. If so, it is skipped. Otherwise, it is read from the imap server
 #    and imported to GMail.
+#
+# Messages that fail are recorded in the dead letter list. Those that failed
+# with a retryable error are retried in a few passes at the end of the run,
+# with an increasing delay between the passes.
+#
+# When a spool is given, the processing stores the messages in the spool
+# instead of importing them to GMail. The spool can later be imported by a
+# processor that reads from a SpoolReader.
 
 
 class Imap2GMailProcessor:
-    __slots__ = '_imapcredentials', '_nrthreads', \
+    __slots__ = '_readerfactory', '_nrthreads', \
                 '_startdate', '_beforedate', '_includedeleted', \
                 '_folderqueue', '_messagequeue', '_gmailclient', '_imapreaders', \
-                '_initialmessagecache', '_messagecache', '_cachefile', '_nrmessages'
-
-    def __init__(self, imapcredentials, gmailclient, nrthreads,
-                 startdate, beforedate,includedeleted, cachefile):
-        self._imapcredentials = imapcredentials
+                '_initialmessagecache', '_messagecache', '_cachefile', '_nrmessages', \
+                '_spool', '_deadletters', '_cachewriter', '_stopping', \
+                '_signalhandlers', '_folders'
+
+    # readerfactory is called once per thread and should return an ImapReader,
+    # or an object with the same services (such as a SpoolReader). gmailclient
+    # may be None if spool is given. deadletters is an optional DeadLetterList.
+    # priority and windowdays set the order of the messages, see
+    # MessageScheduler.
+
+    def __init__(self, readerfactory, gmailclient, nrthreads,
+                 startdate, beforedate,includedeleted, cachefile, spool=None,
+                 deadletters=None, priority=PRIORITY_SIZE, windowdays=None):
+        self._readerfactory = readerfactory
         self._nrthreads = nrthreads
         self._startdate = startdate
         self._beforedate = beforedate
         self._includedeleted=includedeleted
+        self._spool = spool
+        self._deadletters = deadletters
+        self._imapreaders = []
 
         self._folderqueue = queue.SimpleQueue()
-        self._messagequeue = queue.SimpleQueue()
+        self._messagequeue = MessageScheduler( priority, windowdays )
 
         self._gmailclient = gmailclient
-        if self._gmailclient.isOK()==False:
-            return
+        if self._gmailclient is not None:
+            if self._gmailclient.isOK()==False:
+                return
 
-        if self._gmailclient.loadLabels()==False:
-            return
+            if self._gmailclient.loadLabels()==False:
+                return
 
         logging.info(f"Initiating {self._nrthreads} threads.")
-        self._imapreaders = []
         for threadidx in range(self._nrthreads):
-            reader = ImapReader( self._imapcredentials )
+            reader = self._readerfactory()
             if reader.isOK()==False:
                 return
 
             self._imapreaders.append( reader ) 
 
+        startupprofile.mark(f"Connect {self._nrthreads} readers")
+
         self._initialmessagecache = ImapMessageIDList()
         self._initialmessagecache.loadJsonFile( cachefile )
 
         self._messagecache = ImapMessageIDList()
         self._messagecache.loadJsonFile( cachefile )
         self._cachefile = cachefile
+        self._cachewriter = CacheWriter( self._messagecache, cachefile or None )
+        self._stopping = threading.Event()
+        self._signalhandlers = {}
+
+        startupprofile.mark("Load cache")
 
     def isOK(self):
-        return self._gmailclient.isOK() and len(self._imapreaders)>0
+        if self._gmailclient is not None and self._gmailclient.isOK()==False:
+            return False
+
+        return len(self._imapreaders)>0
 
-    # Create a queue of all messages on the imap server that should be imported
+    # Create a queue of all messages on the imap server that should be imported.
+    # If createlabels is False, nothing is changed in GMail.
 
-    def discoverMessages(self):
+    def discoverMessages(self, createlabels=True):
         folders = self._imapreaders[0].retrieveAllFolders()
         if len(folders)<1:
             return False
 
-        if self._gmailclient.addImapFolders( folders )==False:
+        self._folders = folders
+        if self._prepareFolders( folders, createlabels )==False:
             return False
 
         for folder in folders:
             self._folderqueue.put( folder )
 
-        self._messagecache.setFolders( folders )
-        self._initialmessagecache.setFolders( folders )
-
         threads = []
         for threadidx in range(self._nrthreads):
             thread = threading.Thread(target=discoverFolderThreadFunction,
-                                      args=(self,threadidx,))
+                                      args=(self,threadidx,),
+                                      name=f"discover-{threadidx}")
             thread.start()
             threads.append(thread)
 
@@ -92,11 +134,157 @@ class Imap2GMailProcessor:
         for thread in threads:
             thread.join()
 
+        self._messagequeue.schedule()
         self._nrmessages = self._messagequeue.qsize()
 
         return True
 
-    
+
+    # Create a queue of the messages in the dead letter list, without
+    # searching the folders
+
+    def discoverFailedMessages(self):
+        messageids = []
+        for messageid in self._deadletters.messageIDs():
+            if self._initialmessagecache.contains( messageid ):
+                self._deadletters.remove( messageid )
+            else:
+                messageids.append( messageid )
+
+        if len(messageids)==0:
+            logging.info("No failed messages to retry.")
+            self._nrmessages = 0
+            return True
+
+        if self._prepareFolders( sorted({m._folder for m in messageids}) )==False:
+            return False
+
+        for messageid in messageids:
+            self._messagequeue.put( messageid )
+
+        self._messagequeue.schedule()
+        self._nrmessages = len(messageids)
+
+        return True
+
+    # Discover the messages with their sizes, without downloading them or
+    # changing anything in GMail. download is true if the messages would be
+    # downloaded from an IMAP server. Returns a projection of the migration,
+    # see planner.py, or None on error.
+
+    def plan(self, download=True):
+        if self.discoverMessages( createlabels=False )==False:
+            return None
+
+        return createPlan( self._messagequeue.messages(), self._folders,
+                           self._initialmessagecache, self._gmailclient,
+                           self._nrthreads, governor.currentLimits(),
+                           download )
+
+    # Compare the messages in the source with the messages in GMail, see
+    # verifier.py. Nothing is changed in GMail. Missing messages are removed
+    # from the cache and added to the dead letter list, so a run with
+    # --retry_failed imports them. Returns the report, or None on error.
+
+    def verify(self, verifier):
+        folders = self._imapreaders[0].retrieveAllFolders()
+        if len(folders)<1:
+            return None
+
+        self._folders = folders
+        if self._prepareFolders( folders, createlabels=False )==False:
+            return None
+
+        if verifier.open()==False:
+            return None
+
+        try:
+            for folder in folders:
+                self._folderqueue.put( folder )
+
+            threads = []
+            for threadidx in range(self._nrthreads):
+                thread = threading.Thread(target=verifyFolderThreadFunction,
+                                          args=(self,threadidx,verifier,),
+                                          name=f"discover-{threadidx}")
+                thread.start()
+                threads.append(thread)
+
+            for thread in threads:
+                thread.join()
+
+            if self._gmailclient.retrieveMessageHeaders(
+                    self._gmailclient.labelIdsForFolders( folders ),
+                    verifier.addGMailMessage )==False:
+                return None
+
+            messageids = verifier.missingMessageIDs()
+            absent = set()
+            if len(messageids)>0:
+                logging.info(f"Searching all mail for {len(messageids)} "
+                             f"missing Message-IDs.")
+                absent = self._gmailclient.lookupMessageIDs(
+                    messageids, verifier.addGMailMessage )
+
+            report, missing = verifier.createReport( absent )
+        finally:
+            verifier.close()
+
+        for folder, msgid in missing:
+            messageid = ImapMessageID( folder, msgid )
+            self._messagecache.remove( messageid )
+            self._addDeadLetter( messageid, MISSING_ERROR, "Not found in GMail", True )
+
+        if len(missing)>0:
+            if self._cachefile:
+                self._messagecache.writeJSonFile( self._cachefile )
+
+            if self._deadletters is not None:
+                self._deadletters.writeJsonFile()
+
+        return report
+
+    # Search a folder for messages and add their Message-ID and expected
+    # labels to the verifier
+
+    def verifyFolderThreadFunction(self,threadidx,verifier):
+        reader = self._imapreaders[threadidx]
+
+        while True:
+            try:
+                folder = self._folderqueue.get_nowait()
+            except queue.Empty:
+                break
+
+            if reader.setCurrentFolder( folder )==False:
+                continue
+
+            messageids = reader.searchMessages(self._startdate,self._beforedate,
+                                               self._includedeleted)
+            headers = reader.fetchMessageHeaders( messageids )
+
+            messages = []
+            for msgid, (messageid, flags) in headers.items():
+                labels = self._gmailclient.messageLabels( flags, folder )
+                messages.append( (msgid, messageid, labels or []) )
+
+            verifier.addSourceMessages( folder, messages )
+
+    # Create labels, spool folders and cache entries for the folders
+
+    def _prepareFolders(self, folders, createlabels=True):
+        if createlabels and self._gmailclient is not None and \
+           self._gmailclient.addImapFolders( folders )==False:
+            return False
+
+        if self._spool is not None and self._spool.setFolders( folders )==False:
+            return False
+
+        self._messagecache.setFolders( folders )
+        self._initialmessagecache.setFolders( folders )
+
+        return True
+
     # DiscoverFolder function for each thread. Processes messages in the queue
 
     def discoverFolderThreadFunction(self,threadidx):
@@ -112,69 +300,184 @@ class Imap2GMailProcessor:
             if reader.setCurrentFolder( folder ):
                 messageids = reader.searchMessages(self._startdate,self._beforedate,
                                                      self._includedeleted)
+                info = reader.fetchMessageInfo( messageids )
 
                 for messageid in messageids:
-                    self._messagequeue.put( ImapMessageID( folder, messageid ))
+                    size, date = info.get( messageid, (None, None) )
+                    self._messagequeue.put( ImapMessageID( folder, messageid,
+                                                           size, date ))
 
     # Goes through the queue of all messages and imports them to GMail        
 
+    # Returns False if the processing was interrupted.
+
     def process(self):
+        self._installSignalHandlers()
+        self._cachewriter.start()
+
+        try:
+            self._runProcessThreads()
+
+            if self._deadletters is not None:
+                self._deadletters.writeJsonFile()
+                self._retryFailedMessages()
+        finally:
+            self._restoreSignalHandlers()
+            self._cachewriter.stop()
+            if self._deadletters is not None:
+                self._deadletters.writeJsonFile()
+
+        for reader in self._imapreaders:
+            reader.logout()
+
+        return not self._stopping.is_set()
+
+    # On SIGINT (Ctrl-C) or SIGTERM, the threads finish the messages they are
+    # working on, and the cache is written before returning. A second signal
+    # is handled as usual.
+
+    def _installSignalHandlers(self):
+        if threading.current_thread() is not threading.main_thread():
+            return
+
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            self._signalhandlers[signum] = signal.signal( signum, self._onSignal )
+
+    def _restoreSignalHandlers(self):
+        for signum, handler in self._signalhandlers.items():
+            signal.signal( signum, handler )
+
+        self._signalhandlers = {}
 
+    def _onSignal(self, signum, frame):
+        logging.warning("Interrupted. Finishing the messages in progress and saving the cache.")
+        self._stopping.set()
+        signal.signal( signum, self._signalhandlers[signum] )
+
+    # Process the messages that failed with a retryable error again, with an
+    # increasing delay between the passes.
+
+    def _retryFailedMessages(self):
+        for passidx in range(RETRY_PASSES):
+            messageids = self._deadletters.messageIDs( retryableonly=True )
+            if len(messageids)==0:
+                break
+
+            delay = RETRY_BACKOFF_SECONDS * 2**passidx
+            logging.info(f"Retrying {len(messageids)} failed messages in {delay} seconds "
+                         f"(pass {passidx+1} of {RETRY_PASSES}).")
+            if self._stopping.wait( delay ):
+                break
+
+            for messageid in messageids:
+                self._messagequeue.put( messageid )
+
+            self._messagequeue.schedule()
+            self._nrmessages = len(messageids)
+            self._runProcessThreads()
+            self._deadletters.writeJsonFile()
+
+        if len(self._deadletters)>0:
+            logging.warning(f"{len(self._deadletters)} messages were not imported. "
+                            f"Run with --retry_failed to retry them.")
+
+    def _runProcessThreads(self):
         threads = []
         for threadidx in range(self._nrthreads):
-            thread = threading.Thread(target=processThreadFunction,args=(self,threadidx,))
+            thread = threading.Thread(target=processThreadFunction,args=(self,threadidx,),
+                                      name=f"process-{threadidx}")
             thread.start()
             threads.append(thread)
 
         # Wait for all threads to finish
         for thread in threads:
-            thread.join()      
+            thread.join()
 
-        if self._cachefile:
-            self._messagecache.writeJSonFile( self._cachefile )
+    # Record a failed message in the dead letter list
+
+    def _addDeadLetter(self, message, errorclass, error, retryable):
+        if self._deadletters is not None:
+            self._deadletters.add( message, errorclass, error, retryable )
 
     def processThreadFunction(self,threadidx):
         reader = self._imapreaders[threadidx]
         
-        while True:
-            try:
-                message = self._messagequeue.get_nowait()
-            except:
-                break
-
-            messageidx = self._nrmessages - self._messagequeue.qsize()
+        while not self._stopping.is_set():
+            # The governor may limit the number of threads that process a
+            # message at the same time
+            with governor.slot():
+                if self._stopping.is_set():
+                    break
+
+                with tracer.span('queue wait'):
+                    message, largeslot = self._messagequeue.get()
+
+                if message is None:
+                    break
+
+                try:
+                    with tracer.span('message', tracer.MESSAGE,
+                                     { 'folder': message._folder, 'id': message._id }):
+                        self._processMessage( threadidx, reader, message )
+                finally:
+                    self._messagequeue.done( largeslot )
+
+    def _processMessage(self,threadidx,reader,message):
+        messageidx = self._nrmessages - self._messagequeue.qsize()
+
+        folderdisplayname = message._folder.replace(".","/")
+
+        if self._initialmessagecache.contains( message )==True or \
+           (self._spool is not None and self._spool.contains( message )):
+            logging.info( f"Thread {threadidx}: Skipping message {messageidx} of {self._nrmessages} (UID: {message._id} in folder {folderdisplayname})")
+            return
 
-            folderdisplayname = message._folder.replace(".","/")
+        with tracer.span('select'):
+            selected = reader.setCurrentFolder( message._folder )
 
-            if self._initialmessagecache.contains( message )==True:
-                logging.info( f"Thread {threadidx}: Skipping message {messageidx} of {self._nrmessages} (UID: {message._id} in folder {folderdisplayname})")
-                continue
+        if selected==False:
+            self._addDeadLetter( message, FETCH_ERROR, "Cannot select folder", True )
+            return
 
-            if reader.setCurrentFolder( message._folder )==False:
-                continue
+        logging.info(  f"Thread {threadidx}: Processing message {messageidx} of {self._nrmessages} (UID: {message._id} in folder {folderdisplayname})")
+        with tracer.span('fetch'):
+            imapmessage = reader.loadMessage( message._id, message._size )
 
-            logging.info(  f"Thread {threadidx}: Processing message {messageidx} of {self._nrmessages} (UID: {message._id} in folder {folderdisplayname})")
-            imapmessage = reader.loadMessage( message._id )
+        if imapmessage==None:
+            logging.error(f"Thread {threadidx}: Cannot fetch message UID: {message._id}) in folder {folderdisplayname}")
+            self._addDeadLetter( message, FETCH_ERROR, "Cannot fetch message", True )
+            return
 
-            if imapmessage==None:
-                logging.error(f"Thread {threadidx}: Cannot fetch message UID: {message._id}) in folder {folderdisplayname}")
-                continue
+        if self._spool is not None:
+            with tracer.span('spool write'):
+                stored = self._spool.storeMessage( message, imapmessage )
 
-            res = self._gmailclient.importImapMessage( imapmessage, message._folder )
-            if res is None:
-                self._messagecache._foldersidslist[message._folder].append( message._id )
-                if threadidx==0 and self._cachefile:
-                    self._messagecache.writeJSonFile( self._cachefile )
-            else:
-                logging.error(f"Message UID: {message._id} in folder {folderdisplayname} not imported. Error: {res}")
+            if stored==False:
+                self._addDeadLetter( message, SPOOL_ERROR, "Cannot write message to spool", True )
+            elif self._deadletters is not None:
+                self._deadletters.remove( message )
+            return
 
-        reader.logout()
+        res = self._gmailclient.importImapMessage( imapmessage, message._folder )
+        if res is None:
+            with tracer.span('cache commit'):
+                self._cachewriter.add( message )
+                if self._deadletters is not None:
+                    self._deadletters.remove( message )
+        else:
+            logging.error(f"Message UID: {message._id} in folder {folderdisplayname} not imported. Error: {res}")
+            self._addDeadLetter( message, res._errorclass, str(res), res._retryable )
 
 # Wrapper function for discoverFolderThreadFunction        
         
 def discoverFolderThreadFunction(obj,threadnr):
     obj.discoverFolderThreadFunction(threadnr)    
 
+# Wrapper function for verifyFolderThreadFunction
+
+def verifyFolderThreadFunction(obj,threadnr,verifier):
+    obj.verifyFolderThreadFunction(threadnr,verifier)
+
 # Wrapper function for processThreadFunction
 
 def processThreadFunction(obj,threadnr):
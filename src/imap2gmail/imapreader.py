@@ -3,21 +3,34 @@
 # Licenced under the MIT licence, see license.md
 # 
 
+import email.parser
 import json
 import os
 import socket
 from imapclient import IMAPClient
 import logging
+from . import governor
+from .messagereader import MessageReader, parseMessageID
+
+# Maximum number of messages in one FETCH command
+FETCH_BATCH_SIZE = 1000
+
+# Fetches only the Message-ID header, without setting the \Seen flag. The
+# server returns it without PEEK.
+HEADER_FETCH = "BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)]"
+HEADER_RESPONSE = b"BODY[HEADER.FIELDS (MESSAGE-ID)]"
 
 
 # Defines a message (with a message ID in a folder)
 class ImapMessageID:
     folderKey = 'folder'
     idKey = 'id'
-    __slots__ = '_folder', '_id'
-    def __init__(self,folder,id):
+    __slots__ = '_folder', '_id', '_size', '_date'
+    def __init__(self,folder,id,size=None,date=None):
         self._folder = folder
         self._id = id
+        self._size = size
+        self._date = date
 
     def json_serialize(self):
          return {ImapMessageID.folderKey: self._folder, ImapMessageID.idKey: self._id}
@@ -29,7 +42,7 @@ class ImapMessageID:
         }.items()
 
 
-# List of ImapMessageIDs.
+# List of ImapMessageIDs. The ids are kept in a set per folder.
 class ImapMessageIDList:
     __slots__ = '_foldersidslist'
     def __init__(self):
@@ -38,7 +51,7 @@ class ImapMessageIDList:
     def setFolders(self, folders ) -> None:
         for foldername in folders:
             if foldername not in self._foldersidslist:
-                self._foldersidslist[foldername] = []
+                self._foldersidslist[foldername] = set()
 
     # Returns true if checkid exists in the list
     def contains(self, checkid):
@@ -47,9 +60,14 @@ class ImapMessageIDList:
         
         return False
 
+    # Remove an id from the list, if it is in it
+    def remove(self, removeid):
+        if removeid._folder in self._foldersidslist:
+            self._foldersidslist[removeid._folder].discard( removeid._id )
+
     # Load list from json file
     def loadJsonFile(self,filename):
-        if os.path.exists( filename ):
+        if filename and os.path.exists( filename ):
             file =  open(filename, 'rb')
 
             importlist = []
@@ -64,16 +82,23 @@ class ImapMessageIDList:
             for id in importlist:
                 foldername = id['folder']
                 if foldername not in self._foldersidslist:
-                    self._foldersidslist[foldername] = []
+                    self._foldersidslist[foldername] = set()
                 
-                self._foldersidslist[foldername].append( id['id'] )
+                self._foldersidslist[foldername].add( id['id'] )
 
             logging.info(f"Loaded {len(importlist)} cache items from {filename}.")
 
-    # Write list to json file
-    def writeJSonFile(self,filename):
-        file =  open(filename, 'w')
+    # Returns a copy that can be written while this list is modified
+    def copy(self):
+        result = ImapMessageIDList()
+        for folder in self._foldersidslist:
+            result._foldersidslist[folder] = set( self._foldersidslist[folder] )
+
+        return result
 
+    # Write list to json file. The list is written to a temporary file that
+    # replaces the file, so a crash never leaves a partial file.
+    def writeJSonFile(self,filename):
         exportlist = []
         
         for folder in self._foldersidslist:
@@ -83,9 +108,20 @@ class ImapMessageIDList:
 
         json_string = json.dumps([ob.json_serialize() for ob in exportlist])
         logging.info(f"Saving cache file {filename}.")
-        file.write( json_string )
 
-        file.close()
+        tmpfilename = filename + '.tmp'
+        try:
+            with open(tmpfilename, 'w') as file:
+                file.write( json_string )
+                file.flush()
+                os.fsync( file.fileno() )
+
+            os.replace( tmpfilename, filename )
+        except OSError as err:
+            logging.error(f"Cannot write cache file {filename}: {err}")
+            return False
+
+        return True
 
 # Holds host, user, password for an IMAP server
 class ImapCredentials:
@@ -116,7 +152,7 @@ class ImapCredentials:
 # and read messages in those folders.
 # At the end, log out from the server.
 
-class ImapReader:
+class ImapReader(MessageReader):
 
     __slots__ = '_folder', '_client'
 
@@ -209,19 +245,65 @@ class ImapReader:
                 
         return messages
 
+    # Gets the size and INTERNALDATE of messages in the current folder,
+    # without loading them. Returns a dict from message id to (size in bytes,
+    # datetime).
+
+    def fetchMessageInfo(self,msgids):
+        info = {}
+        for start in range(0, len(msgids), FETCH_BATCH_SIZE):
+            batch = msgids[start:start+FETCH_BATCH_SIZE]
+            try:
+                response = self._client.fetch(batch, ["RFC822.SIZE", "INTERNALDATE"])
+            except (IMAPClient.Error, socket.error) as err:
+                logging.error(f"Cannot retrieve message sizes in folder {self._folder}: {err}")
+                return info
+
+            for msgid, data in response.items():
+                info[msgid] = (data.get(b'RFC822.SIZE'), data.get(b'INTERNALDATE'))
+
+        return info
+
+    # Gets the Message-ID header and the flags of messages in the current
+    # folder, without loading the messages. Returns a dict from message id to
+    # (Message-ID, flags).
+
+    def fetchMessageHeaders(self,msgids):
+        headers = {}
+        for start in range(0, len(msgids), FETCH_BATCH_SIZE):
+            batch = msgids[start:start+FETCH_BATCH_SIZE]
+            try:
+                response = self._client.fetch(batch, ["FLAGS", HEADER_FETCH])
+            except (IMAPClient.Error, socket.error) as err:
+                logging.error(f"Cannot retrieve message headers in folder {self._folder}: {err}")
+                return headers
+
+            for msgid, data in response.items():
+                header = email.parser.BytesHeaderParser().parsebytes(
+                    data.get(HEADER_RESPONSE, b''))
+                headers[msgid] = (parseMessageID(header.get('Message-ID')),
+                                  data.get(b'FLAGS', ()))
+
+        return headers
+
     # Loads a message in current folder. Returns an array of Flags, and RFC822
-    # message
+    # message. The download is throttled by the expected size before the
+    # fetch, and by the difference with the real size after it.
 
-    def loadMessage(self,msgid):
+    def loadMessage(self,msgid,size=None):
+        expected = size or 0
+        governor.throttleDownload( expected )
         try:
             response = self._client.fetch(msgid, ["FLAGS", "RFC822"])
-
-            if len(response)==0:
-                return None
         except (IMAPClient.Error, socket.error) as err:
             logging.error(f"Cannot retrieve message {msgid} in folder {self._folder}: {err}")
+            response = None
+
+        if not response:
+            governor.throttleDownload( -expected )
             return None
 
+        governor.throttleDownload( len(response[msgid].get(b'RFC822', b''))-expected )
         return response[msgid]
     
     def logout(self):
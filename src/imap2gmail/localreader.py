@@ -0,0 +1,507 @@
+#
+# Copyright © 2022 Tingdahl ICT Management
+# Licenced under the MIT licence, see license.md
+#
+
+import array
+import datetime
+import logging
+import mmap
+import os
+import re
+import threading
+from .messagereader import MessageReader
+
+# Readers for local archives, so messages can be imported without an IMAP
+# server. Both readers provide the same services as ImapReader.
+
+MAILDIR2IMAPFLAGS = {
+    'D': b'\\Draft',
+    'F': b'\\Flagged',
+    'R': b'\\Answered',
+    'S': b'\\Seen',
+    'T': b'\\Deleted',
+}
+
+KEYWORDSFILE = 'dovecot-keywords'
+INFOSEPARATOR = ':2,'
+INBOX = 'INBOX'
+
+
+# Convert a Maildir info string to IMAP flags. keywords maps the lower case
+# keyword letters to IMAP keywords (such as b'Junk').
+
+def maildirFlagsToImap(info, keywords):
+    flags = []
+    for letter in info:
+        if letter in MAILDIR2IMAPFLAGS:
+            flags.append(MAILDIR2IMAPFLAGS[letter])
+        elif letter in keywords:
+            flags.append(keywords[letter])
+
+    return tuple(flags)
+
+
+# Read the Dovecot keyword file of a Maildir. Returns a dict from keyword
+# letter to keyword.
+
+def readMaildirKeywords(maildir):
+    keywords = {}
+    try:
+        with open(os.path.join(maildir, KEYWORDSFILE), 'rb') as file:
+            for line in file:
+                parts = line.split()
+                if len(parts) == 2 and parts[0].isdigit() and \
+                   int(parts[0]) < 26:
+                    keywords[chr(ord('a') + int(parts[0]))] = parts[1]
+    except OSError:
+        pass
+
+    return keywords
+
+
+# Mimics IMAP's SINCE and BEFORE search criteria. A message without a date is
+# always included.
+
+def isInDateRange(date, startdate, beforedate):
+    if date is None:
+        return True
+
+    if startdate is not None and date < startdate:
+        return False
+
+    if beforedate is not None and date >= beforedate:
+        return False
+
+    return True
+
+
+# Reads a tree of Maildirs. The top level Maildir is INBOX. Sub folders in
+# Maildir++ layout (.Sent, .Archive.2020) and plain directory trees
+# (Sent/, Archive/2020/) both become folders with '.' as separator. The
+# modification time of a message file is used as its received date.
+
+class MaildirReader(MessageReader):
+    __slots__ = '_directory', '_maildirs', '_folder', '_files', '_keywords'
+
+    def __init__(self, directory):
+        self._directory = directory
+        self._maildirs = None
+        self._folder = ""
+        self._files = {}
+        self._keywords = {}
+
+    def isOK(self):
+        return os.path.isdir(self._directory)
+
+    # Get a list of folders in the tree
+    def retrieveAllFolders(self):
+        self._maildirs = self._findMaildirs()
+        return sorted(self._maildirs)
+
+    def setCurrentFolder(self, folder):
+        if folder == self._folder:
+            return True
+
+        if self._maildirs is None:
+            self._maildirs = self._findMaildirs()
+
+        maildir = self._maildirs.get(folder)
+        if maildir is None:
+            logging.error(f"Cannot find Maildir for folder {folder}")
+            return False
+
+        files = {}
+        for subdir in ('new', 'cur'):
+            if not os.path.isdir(os.path.join(maildir, subdir)):
+                continue
+
+            try:
+                filenames = os.listdir(os.path.join(maildir, subdir))
+            except OSError as err:
+                logging.error(f"Cannot read Maildir {maildir}: {err}")
+                return False
+
+            for filename in filenames:
+                msgid = self._messageId(filename)
+                if msgid is None:
+                    continue
+
+                info = filename.partition(INFOSEPARATOR)[2]
+                files[msgid] = (os.path.join(maildir, subdir, filename), info)
+
+        self._files = files
+        self._keywords = readMaildirKeywords(maildir)
+        self._folder = folder
+        return True
+
+    # Gets a list of all message ids in the current folder.
+
+    def searchMessages(self, startdate, beforedate, includedeleted):
+        messages = []
+        for msgid, (path, info) in self._files.items():
+            if not includedeleted and 'T' in info:
+                continue
+
+            if startdate is not None or beforedate is not None:
+                try:
+                    date = datetime.datetime.fromtimestamp(
+                        os.stat(path).st_mtime)
+                except OSError:
+                    date = None
+
+                if not isInDateRange(date, startdate, beforedate):
+                    continue
+
+            messages.append(msgid)
+
+        return sorted(messages)
+
+    def fetchMessageInfo(self, msgids):
+        info = {}
+        for msgid in msgids:
+            if msgid in self._files:
+                try:
+                    stat = os.stat(self._files[msgid][0])
+                except OSError:
+                    continue
+
+                info[msgid] = (stat.st_size,
+                               datetime.datetime.fromtimestamp(stat.st_mtime))
+
+        return info
+
+    # Loads a message in current folder. Returns the same structure as
+    # ImapReader.loadMessage
+
+    def loadMessage(self, msgid, size=None):
+        if msgid not in self._files:
+            return None
+
+        path, info = self._files[msgid]
+        try:
+            with open(path, 'rb') as file:
+                body = file.read()
+        except OSError as err:
+            logging.error(f"Cannot read message {path}: {err}")
+            return None
+
+        return {b'FLAGS': maildirFlagsToImap(info, self._keywords),
+                b'RFC822': body}
+
+    def logout(self):
+        self._files = {}
+        self._folder = ""
+
+    # Find all Maildirs below the directory. Returns a dict from folder name
+    # to path.
+
+    def _findMaildirs(self):
+        maildirs = {}
+        for root, dirs, files in os.walk(self._directory):
+            dirs[:] = sorted(d for d in dirs if d not in ('cur', 'new', 'tmp'))
+            if not os.path.isdir(os.path.join(root, 'cur')):
+                continue
+
+            relpath = os.path.relpath(root, self._directory)
+            if relpath == '.':
+                folder = INBOX
+            else:
+                folder = '.'.join(part.lstrip('.')
+                                  for part in relpath.split(os.sep))
+
+            maildirs[folder] = root
+
+        return maildirs
+
+    # The unique part of the file name identifies the message
+    def _messageId(self, filename):
+        if filename.startswith('.'):
+            return None
+
+        return filename.partition(INFOSEPARATOR)[0]
+
+
+# mbox support.
+#
+# An mbox file is scanned once through a memory map, and the byte offset of
+# each "From " line is stored in an index. The index is shared by all
+# readers, while each reader maps the file by itself and only copies the
+# message it loads. Thereby, large mbox files are imported in parallel by
+# all threads without being read into memory.
+#
+# The message id is the position of the message in the file, starting at 1.
+
+FROMLINE = b'From '
+MBOXEXTENSIONS = ('.mbox', '.mbx', '.sbd')
+MBOXSKIPEXTENSIONS = ('.msf', '.dat', '.json', '.idx')
+FROMDATEFORMAT = '%a %b %d %H:%M:%S %Y'
+
+# mboxrd quotes lines starting with "From " (after any number of '>') with
+# one more '>'
+FROMQUOTEREGEX = re.compile(rb'^>(>*From )', re.MULTILINE)
+
+STATUSREGEX = re.compile(rb'^(X-)?Status:[ \t]*([A-Za-z]*)',
+                         re.MULTILINE | re.IGNORECASE)
+STATUS2IMAPFLAGS = {b'R': b'\\Seen'}
+XSTATUS2IMAPFLAGS = {
+    b'A': b'\\Answered',
+    b'F': b'\\Flagged',
+    b'D': b'\\Deleted',
+    b'T': b'\\Draft',
+}
+
+
+# Scan an mbox file and return the start offset of every message, followed
+# by the size of the file.
+
+def buildMboxIndex(filename):
+    index = array.array('Q')
+    with open(filename, 'rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        if size == 0:
+            index.append(0)
+            return index
+
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as map:
+            if map[:len(FROMLINE)] == FROMLINE:
+                index.append(0)
+
+            pos = map.find(b'\n' + FROMLINE)
+            while pos >= 0:
+                index.append(pos + 1)
+                pos = map.find(b'\n' + FROMLINE, pos + 1)
+
+    index.append(size)
+    return index
+
+
+# Parse the date of an mbox "From " line, such as
+# From sender@example.com Wed Jan  5 10:00:00 2022
+
+def parseFromLineDate(fromline):
+    parts = fromline.decode('ascii', 'replace').split()
+    if len(parts) < 6:
+        return None
+
+    try:
+        return datetime.datetime.strptime(' '.join(parts[-5:]),
+                                          FROMDATEFORMAT)
+    except ValueError:
+        return None
+
+
+# Remove the mboxrd quoting of "From " lines
+def unquoteFromLines(body):
+    if FROMQUOTEREGEX.search(body) is None:
+        return body
+
+    return FROMQUOTEREGEX.sub(rb'\1', body)
+
+
+# Read the Status and X-Status headers that mail clients use to store flags
+def parseMboxFlags(headers):
+    flags = []
+    for match in STATUSREGEX.finditer(headers):
+        mapping = XSTATUS2IMAPFLAGS if match.group(1) else STATUS2IMAPFLAGS
+        for letter in match.group(2).upper():
+            flag = mapping.get(bytes((letter,)))
+            if flag is not None and flag not in flags:
+                flags.append(flag)
+
+    return tuple(flags)
+
+
+# A file, or a tree of mbox files. Each file is a folder, named after its
+# path relative to the top directory, with '.' as separator. Thunderbird's
+# .sbd directories and .msf files are handled.
+
+class MboxArchive:
+    __slots__ = '_path', '_files', '_indexes', '_locks'
+
+    def __init__(self, path):
+        self._path = path
+        self._files = {}
+        self._indexes = {}
+        self._locks = {}
+
+        if os.path.isfile(path):
+            self._addFile(os.path.basename(path), path)
+        else:
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for filename in sorted(files):
+                    filepath = os.path.join(root, filename)
+                    relpath = os.path.relpath(filepath, path)
+                    self._addFile(relpath, filepath)
+
+        for folder in self._files:
+            self._locks[folder] = threading.Lock()
+
+    def isOK(self):
+        return len(self._files) > 0
+
+    def folders(self):
+        return list(self._files)
+
+    def fileName(self, folder):
+        return self._files.get(folder)
+
+    # Returns the index of the folder's mbox, and builds it on first use
+    def index(self, folder):
+        with self._locks[folder]:
+            if folder not in self._indexes:
+                logging.info(f"Indexing mbox {self._files[folder]}")
+                self._indexes[folder] = buildMboxIndex(self._files[folder])
+
+            return self._indexes[folder]
+
+    def _addFile(self, relpath, filepath):
+        if relpath.startswith('.') or relpath.endswith(MBOXSKIPEXTENSIONS):
+            return
+
+        try:
+            with open(filepath, 'rb') as file:
+                if file.read(len(FROMLINE)) != FROMLINE:
+                    return
+        except OSError as err:
+            logging.error(f"Cannot read {filepath}: {err}")
+            return
+
+        parts = []
+        for part in relpath.split(os.sep):
+            for extension in MBOXEXTENSIONS:
+                if part.endswith(extension):
+                    part = part[:-len(extension)]
+                    break
+            parts.append(part)
+
+        self._files['.'.join(parts)] = filepath
+
+
+# Reads messages from an MboxArchive. One reader per thread.
+class MboxReader(MessageReader):
+    __slots__ = '_archive', '_folder', '_file', '_map', '_index'
+
+    def __init__(self, archive):
+        self._archive = archive
+        self._folder = ""
+        self._file = None
+        self._map = None
+        self._index = None
+
+    def isOK(self):
+        return self._archive.isOK()
+
+    def retrieveAllFolders(self):
+        return self._archive.folders()
+
+    def setCurrentFolder(self, folder):
+        if folder == self._folder:
+            return True
+
+        filename = self._archive.fileName(folder)
+        if filename is None:
+            logging.error(f"Cannot find mbox for folder {folder}")
+            return False
+
+        self._close()
+        try:
+            self._index = self._archive.index(folder)
+            self._file = open(filename, 'rb')
+            if self._index[-1] > 0:
+                self._map = mmap.mmap(self._file.fileno(), 0,
+                                      access=mmap.ACCESS_READ)
+        except (OSError, ValueError) as err:
+            logging.error(f"Cannot open mbox {filename}: {err}")
+            self._close()
+            return False
+
+        self._folder = folder
+        return True
+
+    # Gets a list of all message ids in the current folder. Dates are read
+    # from the "From " lines.
+
+    def searchMessages(self, startdate, beforedate, includedeleted):
+        nrmessages = len(self._index) - 1
+        if includedeleted and startdate is None and beforedate is None:
+            return list(range(1, nrmessages + 1))
+
+        messages = []
+        for msgid in range(1, nrmessages + 1):
+            start, bodystart, headerend, end = self._locate(msgid)
+
+            if not includedeleted and b'\\Deleted' in \
+               parseMboxFlags(self._map[bodystart:headerend]):
+                continue
+
+            date = parseFromLineDate(self._map[start:bodystart])
+            if not isInDateRange(date, startdate, beforedate):
+                continue
+
+            messages.append(msgid)
+
+        return messages
+
+    # The size is the distance to the next message in the index, and the
+    # date is read from the "From " line.
+
+    def fetchMessageInfo(self, msgids):
+        info = {}
+        for msgid in msgids:
+            if 0 < msgid < len(self._index):
+                start, bodystart, headerend, end = self._locate(msgid)
+                info[msgid] = (end - start,
+                               parseFromLineDate(self._map[start:bodystart]))
+
+        return info
+
+    # Loads a message in current folder. Returns the same structure as
+    # ImapReader.loadMessage
+
+    def loadMessage(self, msgid, size=None):
+        if self._map is None or msgid < 1 or msgid >= len(self._index):
+            return None
+
+        start, bodystart, headerend, end = self._locate(msgid)
+        body = self._map[bodystart:end]
+
+        # Remove the empty line that separates the messages. The index has an
+        # offset for each message, and the end of the file.
+        if msgid < len(self._index) - 1 and body.endswith(b'\n'):
+            body = body[:-1]
+
+        return {b'FLAGS': parseMboxFlags(self._map[bodystart:headerend]),
+                b'RFC822': unquoteFromLines(body)}
+
+    def logout(self):
+        self._close()
+
+    # Returns the start of the "From " line, the start of the message, the
+    # end of the headers and the end of the message.
+
+    def _locate(self, msgid):
+        start = self._index[msgid - 1]
+        end = self._index[msgid]
+        bodystart = self._map.find(b'\n', start, end) + 1
+        if bodystart == 0:
+            bodystart = end
+
+        headerend = self._map.find(b'\n\n', bodystart, end)
+        if headerend < 0:
+            headerend = end
+
+        return start, bodystart, headerend, end
+
+    def _close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+        self._index = None
+        self._folder = ""
@@ -0,0 +1,91 @@
+#
+# Copyright © 2022 Tingdahl ICT Management
+# Licenced under the MIT licence, see license.md
+#
+
+import email.parser
+from abc import ABC, abstractmethod
+
+# Interface for a source of messages. The processor creates one reader per
+# thread, so a reader is only used by one thread at the time.
+#
+# Happy flow is the same as for an IMAP server: call retrieveAllFolders,
+# select each folder with setCurrentFolder, search for messages and load them.
+# At the end, logout is called.
+#
+# Implementations are ImapReader (an IMAP server), SpoolReader (the local
+# spool), MaildirReader and MboxReader (local archives). A reader that does
+# not implement all abstract methods cannot be created.
+
+class MessageReader(ABC):
+    __slots__ = ()
+
+    @abstractmethod
+    def isOK(self):
+        pass
+
+    # Get a list of folder names
+    @abstractmethod
+    def retrieveAllFolders(self):
+        pass
+
+    # Select the folder that searchMessages and loadMessage work on
+    @abstractmethod
+    def setCurrentFolder(self, folder):
+        pass
+
+    # Gets a list of all message ids in the current folder that are received
+    # between startdate and beforedate (both may be None).
+
+    @abstractmethod
+    def searchMessages(self, startdate, beforedate, includedeleted):
+        pass
+
+    # Gets the size and received date of messages in the current folder,
+    # without loading them. Returns a dict from message id to (size in bytes,
+    # datetime). Messages may be missing, or have None as size or date, if
+    # they are not known.
+
+    def fetchMessageInfo(self, msgids):
+        return {}
+
+    # Gets the Message-ID header and the flags of messages in the current
+    # folder. Returns a dict from message id to (Message-ID, flags), where
+    # Message-ID is None if the message has none. This implementation loads
+    # each message; readers that can fetch the headers only should override
+    # it.
+
+    def fetchMessageHeaders(self, msgids):
+        headers = {}
+        parser = email.parser.BytesHeaderParser()
+        for msgid in msgids:
+            message = self.loadMessage(msgid)
+            if message is None:
+                continue
+
+            header = parser.parsebytes(message[b'RFC822'])
+            headers[msgid] = (parseMessageID(header.get('Message-ID')),
+                              message[b'FLAGS'])
+
+        return headers
+
+    # Loads a message in current folder. Returns a dict with b'FLAGS' (a
+    # sequence of IMAP flags as bytes) and b'RFC822' (the raw message), or
+    # None if the message cannot be read. size is the size of the message
+    # from fetchMessageInfo, or None if it is not known.
+
+    @abstractmethod
+    def loadMessage(self, msgid, size=None):
+        pass
+
+    def logout(self):
+        pass
+
+
+# Returns the Message-ID without whitespace, or None if it is empty
+def parseMessageID(value):
+    if value is None:
+        return None
+
+    value = str(value).strip()
+    return value or None
@@ -0,0 +1,140 @@
+#
+# Copyright © 2022 Tingdahl ICT Management
+# Licenced under the MIT licence, see license.md
+#
+
+import logging
+from .gmailimapimporter import MAX_CALLS_PER_SECOND, \
+    MAX_QUOTA_UNITS_PER_SECOND, QUOTA_UNITS_DRAFT, QUOTA_UNITS_IMPORT, \
+    QUOTA_UNITS_LABEL
+
+# Multipart headers and labels of a media upload
+UPLOAD_OVERHEAD_BYTES = 400
+
+# Assumed number of bytes per second that one thread downloads and uploads,
+# as the bandwidth of the links is not known
+THREAD_BYTES_PER_SECOND = 512 * 1024
+
+# Projection of a migration, made from the discovered messages without
+# downloading them. Each pending message is one GMail call (an import, or a
+# draft create for the drafts folder), and each missing label is one label
+# create. The time is limited by the slowest of:
+#
+# - the rate limiter, which all threads share
+# - GMail's quota units per second
+# - the threads, which each download and upload THREAD_BYTES_PER_SECOND
+# - the download and upload rates of the governor, if they are set
+#
+# Messages are only downloaded from an IMAP server; local archives and the
+# spool are read from disk.
+
+
+# Size of a message when it is uploaded. Messages are sent as media uploads,
+# so only the multipart headers are added.
+def uploadSize(size):
+    return size + UPLOAD_OVERHEAD_BYTES
+
+
+def emptyTotals():
+    return {'messages': 0, 'cached': 0, 'pending': 0,
+            'bytes': 0, 'pending_bytes': 0, 'upload_bytes': 0,
+            'api_calls': 0, 'quota_units': 0}
+
+
+# Time to make the calls and transfer the bytes, and what limits it.
+# limits are the governor's limits, see governor.currentLimits.
+
+def estimateSeconds(apicalls, quotaunits, downloadbytes, uploadbytes, limits,
+                    nrthreads):
+    threads = min(nrthreads, limits['threads'] or nrthreads)
+    bounds = {'rate limit': apicalls / MAX_CALLS_PER_SECOND,
+              'quota': quotaunits / MAX_QUOTA_UNITS_PER_SECOND,
+              'thread throughput': (downloadbytes + uploadbytes) /
+              (threads * THREAD_BYTES_PER_SECOND)}
+    if limits['download_rate'] is not None:
+        bounds['download rate'] = downloadbytes / limits['download_rate']
+
+    if limits['upload_rate'] is not None:
+        bounds['upload rate'] = uploadbytes / limits['upload_rate']
+
+    boundby = max(bounds, key=bounds.get)
+    return bounds[boundby], boundby
+
+
+# Create the plan. messages are the discovered ImapMessageIDs, folders all
+# folders of the source, and cache the messages that are already imported.
+# download is true if the messages are downloaded from an IMAP server.
+
+def createPlan(messages, folders, cache, gmailclient, nrthreads, limits,
+               download):
+    totals = emptyTotals()
+    perfolder = {}
+    drafts = {}
+
+    for folder in folders:
+        perfolder[folder] = emptyTotals()
+        drafts[folder] = gmailclient.isDraftFolder(folder)
+        perfolder[folder]['drafts'] = drafts[folder]
+
+    messagesunknownsize = 0
+    for message in messages:
+        size = message._size or 0
+        if message._size is None:
+            messagesunknownsize += 1
+
+        for item in (totals, perfolder[message._folder]):
+            item['messages'] += 1
+            item['bytes'] += size
+
+            if cache.contains(message):
+                item['cached'] += 1
+                continue
+
+            item['pending'] += 1
+            item['pending_bytes'] += size
+            item['upload_bytes'] += uploadSize(size)
+            item['api_calls'] += 1
+            item['quota_units'] += QUOTA_UNITS_DRAFT \
+                if drafts[message._folder] else QUOTA_UNITS_IMPORT
+
+    def estimate(item):
+        return estimateSeconds(item['api_calls'], item['quota_units'],
+                               item['pending_bytes'] if download else 0,
+                               item['upload_bytes'], limits, nrthreads)
+
+    for item in perfolder.values():
+        item['estimated_seconds'] = estimate(item)[0]
+
+    labelstocreate = gmailclient.missingLabels(folders)
+    totals['labels_to_create'] = len(labelstocreate)
+    totals['api_calls'] += len(labelstocreate)
+    totals['quota_units'] += len(labelstocreate) * QUOTA_UNITS_LABEL
+    totals['messages_with_unknown_size'] = messagesunknownsize
+
+    seconds, boundby = estimate(totals)
+
+    return {'threads': nrthreads,
+            'max_calls_per_second': MAX_CALLS_PER_SECOND,
+            'max_quota_units_per_second': MAX_QUOTA_UNITS_PER_SECOND,
+            'thread_bytes_per_second': THREAD_BYTES_PER_SECOND,
+            'limits': limits,
+            'download': download,
+            'totals': totals,
+            'labels_to_create': labelstocreate,
+            'estimated_seconds': seconds,
+            'bound_by': boundby,
+            'folders': perfolder}
+
+
+# Log a short summary of the plan
+def logPlan(plan):
+    totals = plan['totals']
+    seconds = plan['estimated_seconds']
+    logging.info(f"Plan: {totals['pending']} of {totals['messages']} messages "
+                 f"to import ({totals['cached']} already imported), "
+                 f"{totals['pending_bytes']/1024/1024:.1f} MB, "
+                 f"{totals['labels_to_create']} labels to create.")
+    logging.info(f"Plan: {totals['api_calls']} API calls, "
+                 f"{totals['quota_units']} quota units. Estimated time "
+                 f"{seconds/3600:.1f} hours, limited by the "
+                 f"{plan['bound_by']}.")
@@ -0,0 +1,208 @@
+#
+# Copyright © 2022 Tingdahl ICT Management
+# Licenced under the MIT licence, see license.md
+#
+
+import collections
+import datetime
+import logging
+import threading
+
+# Messages of this size or larger are large
+LARGE_MESSAGE_BYTES = 5 * 1024 * 1024
+
+# Maximum number of large messages that are processed at the same time
+MAX_CONCURRENT_LARGE_MESSAGES = 3
+
+# Orders of the messages
+PRIORITY_SIZE = 'size'
+PRIORITY_NEWEST = 'newest'
+
+# Length of a date window with PRIORITY_NEWEST, unless given
+DEFAULT_WINDOW_DAYS = 30
+
+# Index of the window of messages with an unknown date
+UNKNOWN_DATE_WINDOW = 1 << 62
+
+
+# Decides the order in which the processing threads take messages.
+#
+# Messages are processed largest first, so the run does not end with a few
+# threads working on large messages while the others are idle. As all
+# threads take from the same queue, each thread thereby processes a similar
+# number of bytes rather than a similar number of messages.
+#
+# Large messages are kept in a separate queue, and only a few of them are
+# processed at the same time. A thread that cannot get a slot for a large
+# message takes a small one instead, so large messages do not starve the
+# small ones.
+#
+# With PRIORITY_NEWEST, the messages of all folders are split in windows of
+# windowdays days by their received date, and the windows are processed
+# newest first. Recent mail is thereby available in GMail first, while the
+# archive follows in the same run. Within a window, messages are processed
+# largest first as above. Messages with an unknown date are in the last
+# window.
+
+class MessageScheduler:
+    __slots__ = '_lock', '_pending', '_windows', '_largeslots', \
+                '_priority', '_windowdays'
+
+    def __init__(self, priority=PRIORITY_SIZE, windowdays=None):
+        self._lock = threading.Lock()
+        self._pending = []
+        self._windows = collections.deque()
+        self._largeslots = threading.BoundedSemaphore(
+            MAX_CONCURRENT_LARGE_MESSAGES)
+        self._priority = priority
+        self._windowdays = windowdays or DEFAULT_WINDOW_DAYS
+
+    # Add a message. It is not available to get until schedule is called.
+    def put(self, messageid):
+        with self._lock:
+            self._pending.append(messageid)
+
+    # Order the added messages in windows, and largest first within a
+    # window. Messages with an unknown size are processed after the ones with
+    # a known size.
+
+    def schedule(self):
+        with self._lock:
+            windows = {}
+            newest = None
+            if self._priority == PRIORITY_NEWEST:
+                newest = max((messageid._date for messageid in self._pending
+                              if messageid._date is not None), default=None)
+                for messageid in self._pending:
+                    index = windowIndex(messageid._date, newest,
+                                        self._windowdays)
+                    windows.setdefault(index, []).append(messageid)
+            elif self._pending:
+                windows[0] = self._pending
+
+            nrbytes = 0
+            nrlarge = 0
+            for index in sorted(windows):
+                window = Window(self._windowLabel(index, newest)
+                                if self._priority == PRIORITY_NEWEST
+                                else None)
+                windows[index].sort(key=messageSize, reverse=True)
+                for messageid in windows[index]:
+                    size = messageSize(messageid)
+                    nrbytes += size
+                    if size >= LARGE_MESSAGE_BYTES:
+                        window._large.append(messageid)
+                        nrlarge += 1
+                    else:
+                        window._small.append(messageid)
+
+                self._windows.append(window)
+
+            nrmessages = len(self._pending)
+            self._pending = []
+
+        logging.info(f"Scheduled {nrmessages} messages "
+                     f"({nrbytes/1024/1024:.1f} MB, {nrlarge} "
+                     f"large messages).")
+        if self._priority == PRIORITY_NEWEST:
+            logging.info(f"Messages are processed newest first, in "
+                         f"{len(windows)} windows of {self._windowdays} "
+                         f"days.")
+
+    # Description of the dates of a window for the log
+    def _windowLabel(self, index, newest):
+        if index == UNKNOWN_DATE_WINDOW:
+            return "messages with unknown date"
+
+        end = newest.date() - datetime.timedelta(days=index *
+                                                 self._windowdays)
+        start = end - datetime.timedelta(days=self._windowdays - 1)
+        return f"messages received {start} to {end}"
+
+    # Returns the next message and whether it holds a slot for a large
+    # message, which must be given back with done(). Returns (None, False)
+    # when there are no messages left.
+
+    def get(self):
+        with self._lock:
+            self._dropEmptyWindows()
+            for window in self._windows:
+                if window._large and \
+                   self._largeslots.acquire(blocking=False):
+                    return window._large.popleft(), True
+
+                if window._small:
+                    return window._small.popleft(), False
+
+            if not self._windows:
+                return None, False
+
+        # Only large messages are left, and all slots are taken
+        self._largeslots.acquire()
+        with self._lock:
+            for window in self._windows:
+                if window._large:
+                    return window._large.popleft(), True
+
+        self._largeslots.release()
+        return None, False
+
+    # Remove the windows that have no messages left, and log when the
+    # processing of a window starts
+
+    def _dropEmptyWindows(self):
+        while self._windows and not self._windows[0]._large and \
+                not self._windows[0]._small:
+            self._windows.popleft()
+
+        if self._windows and not self._windows[0]._started:
+            self._windows[0]._started = True
+            if self._windows[0]._label is not None:
+                logging.info(f"Starting {self._windows[0]._label}.")
+
+    def done(self, largeslot):
+        if largeslot:
+            self._largeslots.release()
+
+    # Returns the messages that are not taken yet, in scheduled order
+    def messages(self):
+        with self._lock:
+            result = []
+            for window in self._windows:
+                result.extend(window._large)
+                result.extend(window._small)
+
+            return result + self._pending
+
+    # Number of messages that are not taken yet
+    def qsize(self):
+        with self._lock:
+            return len(self._pending) + \
+                sum(len(window._large) + len(window._small)
+                    for window in self._windows)
+
+
+# Messages of a date window, split in large and small messages
+class Window:
+    __slots__ = '_label', '_large', '_small', '_started'
+
+    def __init__(self, label):
+        self._label = label
+        self._large = collections.deque()
+        self._small = collections.deque()
+        self._started = False
+
+
+# Size of a message for scheduling. Unknown sizes count as 0.
+def messageSize(messageid):
+    return messageid._size or 0
+
+
+# Index of the window of a date, counted from the window of the newest date.
+# Messages with an unknown date get a window after all others.
+
+def windowIndex(date, newest, windowdays):
+    if date is None:
+        return UNKNOWN_DATE_WINDOW
+
+    return (newest.date() - date.date()).days // windowdays
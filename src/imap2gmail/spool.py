@@ -0,0 +1,208 @@
+#
+# Copyright © 2022 Tingdahl ICT Management
+# Licenced under the MIT licence, see license.md
+#
+
+import logging
+import os
+import socket
+import urllib.parse
+from .localreader import INFOSEPARATOR, KEYWORDSFILE, MaildirReader
+
+# Local on-disk spool of fetched IMAP messages.
+#
+# The spool is a tree of Maildirs, one per IMAP folder. The directory name is
+# the url-quoted IMAP folder name, and each message is stored in cur/ as
+#
+#    <uid>.<hostname>:2,<flags>
+#
+# The UID is the message id of the source. Integer ids (IMAP UIDs and mbox
+# message numbers) are written as they are. Other ids (Maildir file names)
+# are url-quoted, with the dots quoted too, and get an 's' in front, so they
+# are read back as the same string.
+#
+# IMAP system flags map to the standard Maildir flags. The Junk and NonJunk
+# keywords are stored as Dovecot style keyword letters, and are listed in the
+# dovecot-keywords file of each Maildir. This keeps the folder name, the UID
+# and all flags that the GMail import uses in the file system, without any
+# index that has to be kept in sync.
+
+IMAP2MAILDIRFLAGS = {
+    b'\\Draft': 'D',
+    b'\\Flagged': 'F',
+    b'\\Answered': 'R',
+    b'\\Seen': 'S',
+    b'\\Deleted': 'T',
+    b'Junk': 'a',
+    b'NonJunk': 'b',
+}
+
+KEYWORDS = '0 Junk\n1 NonJunk\n'
+
+# Marks a UID in a file name that is a quoted string id
+STRINGIDMARKER = 's'
+
+
+# Convert between IMAP folder names and Maildir directory names
+def folderToDirName(folder):
+    return urllib.parse.quote(folder, safe='')
+
+
+def dirNameToFolder(dirname):
+    return urllib.parse.unquote(dirname)
+
+
+# Convert a sequence of IMAP flags to a Maildir info string
+def imapFlagsToMaildir(flags):
+    letters = [IMAP2MAILDIRFLAGS[flag] for flag in flags
+               if flag in IMAP2MAILDIRFLAGS]
+    return ''.join(sorted(set(letters)))
+
+
+# Convert between message ids of the source and the UID part of spool file
+# names
+def messageIdToUid(msgid):
+    if isinstance(msgid, int):
+        return str(msgid)
+
+    return STRINGIDMARKER + \
+        urllib.parse.quote(str(msgid), safe='').replace('.', '%2E')
+
+
+def uidToMessageId(uid):
+    if uid.isdigit():
+        return int(uid)
+
+    if uid.startswith(STRINGIDMARKER) and len(uid) > 1:
+        return urllib.parse.unquote(uid[1:])
+
+    return None
+
+
+# Split a Maildir file name into its message id and its flags. Returns None
+# for files that are not written by MessageSpool
+def parseMaildirFileName(filename):
+    base, separator, info = filename.partition(INFOSEPARATOR)
+    msgid = uidToMessageId(base.split('.', 1)[0])
+    if msgid is None:
+        return None
+
+    return msgid, info
+
+
+# Writes messages fetched from IMAP to the spool. Safe to be used from
+# multiple threads, as long as each message is only stored by one thread.
+class MessageSpool:
+    __slots__ = '_directory', '_spooled', '_hostname'
+
+    def __init__(self, directory):
+        self._directory = directory
+        self._spooled = {}
+        self._hostname = socket.gethostname().replace('/', '_') \
+            .replace(':', '_')
+
+    # Create the Maildirs for the folders, and read which messages are
+    # already in the spool from a previous run
+
+    def setFolders(self, folders):
+        for folder in folders:
+            if folder in self._spooled:
+                continue
+
+            maildir = os.path.join(self._directory, folderToDirName(folder))
+            try:
+                for subdir in ('cur', 'new', 'tmp'):
+                    os.makedirs(os.path.join(maildir, subdir), exist_ok=True)
+
+                keywordsfile = os.path.join(maildir, KEYWORDSFILE)
+                if not os.path.exists(keywordsfile):
+                    with open(keywordsfile, 'w') as file:
+                        file.write(KEYWORDS)
+            except OSError as err:
+                logging.critical(f"Cannot create spool folder {maildir}: "
+                                 f"{err}")
+                return False
+
+            spooled = set()
+            for filename in os.listdir(os.path.join(maildir, 'cur')):
+                parsed = parseMaildirFileName(filename)
+                if parsed is not None:
+                    spooled.add(parsed[0])
+
+            self._spooled[folder] = spooled
+
+        return True
+
+    # Returns true if the message is already in the spool
+    def contains(self, messageid):
+        if messageid._folder in self._spooled:
+            return messageid._id in self._spooled[messageid._folder]
+
+        return False
+
+    # Store a message as returned by ImapReader.loadMessage. The message is
+    # written to tmp/ and renamed into cur/, so a crash never leaves a
+    # partial message in the spool. The file gets the received date of the
+    # message, if it is known, so the upload can be ordered by date.
+
+    def storeMessage(self, messageid, imapmessage):
+        maildir = os.path.join(self._directory,
+                               folderToDirName(messageid._folder))
+        filename = f"{messageIdToUid(messageid._id)}.{self._hostname}" \
+                   f"{INFOSEPARATOR}" \
+                   f"{imapFlagsToMaildir(imapmessage[b'FLAGS'])}"
+        tmpfile = os.path.join(maildir, 'tmp', filename)
+
+        try:
+            with open(tmpfile, 'wb') as file:
+                file.write(imapmessage[b'RFC822'])
+                file.flush()
+                os.fsync(file.fileno())
+
+            if messageid._date is not None:
+                timestamp = messageid._date.timestamp()
+                os.utime(tmpfile, (timestamp, timestamp))
+
+            os.replace(tmpfile, os.path.join(maildir, 'cur', filename))
+        except OSError as err:
+            logging.error(f"Cannot write message {messageid._id} to spool "
+                          f"{maildir}: {err}")
+            return False
+
+        self._spooled[messageid._folder].add(messageid._id)
+        return True
+
+
+# Reads messages from the spool, so the spool can be uploaded with the normal
+# processing.
+class SpoolReader(MaildirReader):
+    __slots__ = ()
+
+    # The date limits are already applied when the spool was filled. The
+    # file dates are the received dates of the messages, or the time of
+    # fetching if they were unknown.
+
+    def searchMessages(self, startdate, beforedate, includedeleted):
+        return super().searchMessages(None, None, includedeleted)
+
+    def _findMaildirs(self):
+        maildirs = {}
+        try:
+            dirnames = os.listdir(self._directory)
+        except OSError as err:
+            logging.critical(f"Cannot read spool {self._directory}: {err}")
+            return maildirs
+
+        for dirname in dirnames:
+            maildir = os.path.join(self._directory, dirname)
+            if os.path.isdir(os.path.join(maildir, 'cur')):
+                maildirs[dirNameToFolder(dirname)] = maildir
+
+        return maildirs
+
+    def _messageId(self, filename):
+        parsed = parseMaildirFileName(filename)
+        if parsed is None:
+            return None
+
+        return parsed[0]
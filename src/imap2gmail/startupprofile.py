@@ -0,0 +1,50 @@
+#
+# Copyright © 2022 Tingdahl ICT Management
+# Licenced under the MIT licence, see license.md
+#
+
+import logging
+import threading
+import time
+
+# Measures where the time goes between start of the program and start of the
+# processing. The code calls mark() after each step of the startup, and the
+# time since the previous mark is booked on that step. The profile is only
+# reported if it is enabled with --profile_startup.
+
+_starttime = time.perf_counter()
+_lasttime = _starttime
+_steps = []
+_enabled = False
+_lock = threading.Lock()
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+# Book the time since the previous mark on step
+def mark(step):
+    global _lasttime
+    with _lock:
+        now = time.perf_counter()
+        _steps.append((step, now - _lasttime))
+        _lasttime = now
+
+
+# Log the time of each step, and its share of the total. Only the first
+# startup is reported.
+
+def report():
+    global _enabled
+    if not _enabled:
+        return
+
+    with _lock:
+        _enabled = False
+        total = _lasttime - _starttime
+        logging.info(f"Startup profile ({total*1000:.0f} ms in total):")
+        for step, duration in _steps:
+            share = 100 * duration / total if total > 0 else 0
+            logging.info(f"  {duration*1000:8.1f} ms {share:5.1f}%  {step}")
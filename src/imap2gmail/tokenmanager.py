@@ -0,0 +1,159 @@
+#
+# Copyright © 2022 Tingdahl ICT Management
+# Licenced under the MIT licence, see license.md
+#
+
+import datetime
+import logging
+import os
+import tempfile
+import threading
+
+# Refresh the token this long before it expires
+REFRESH_MARGIN_SECONDS = 300
+
+# Wait this long before trying again if a refresh fails
+REFRESH_RETRY_SECONDS = 30
+
+# Maximum time an upload waits for a valid token
+WAIT_FOR_TOKEN_SECONDS = 60
+
+
+# Keeps the OAuth token of the GMail credentials valid.
+#
+# A background thread refreshes the token some minutes before it expires and
+# writes it to the token file. Refreshes are serialized by a lock, and a
+# refresh that finds a token that has just been refreshed by another thread
+# returns without calling Google. The upload threads only check if the token
+# is valid, which never blocks as long as the background thread keeps up.
+
+class TokenManager:
+    __slots__ = '_creds', '_tokenfile', '_lock', '_refreshed', '_wakeup', \
+                '_stop', '_thread'
+
+    def __init__(self, creds, tokenfile):
+        self._creds = creds
+        self._tokenfile = tokenfile
+        self._lock = threading.Lock()
+        self._refreshed = threading.Condition()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    # Start the background refresh
+    def start(self):
+        if self._thread is not None:
+            return
+
+        self._thread = threading.Thread(target=refreshThreadFunction,
+                                        args=(self,), daemon=True)
+        self._thread.start()
+
+    # Stop the background refresh, and wait for it to finish
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    # Refresh the token if it is expired or about to expire. Concurrent calls
+    # are coalesced into one refresh.
+
+    def refresh(self):
+        from google.auth.transport.requests import Request
+
+        with self._lock:
+            if self._creds.valid and \
+               self._secondsToExpiry() > REFRESH_MARGIN_SECONDS:
+                return True
+
+            if not self._creds.refresh_token:
+                return self._creds.valid
+
+            try:
+                self._creds.refresh(Request())
+            except Exception as error:
+                logging.error(f"Could not refresh GMail token: {error}")
+                return False
+
+            self.writeToken()
+
+        with self._refreshed:
+            self._refreshed.notify_all()
+
+        return True
+
+    # Called before each GMail call. Returns immediately if the token is
+    # valid. Otherwise, the background thread is woken up and the call waits
+    # until it has refreshed the token. Fails immediately if the token cannot
+    # be refreshed.
+
+    def waitForValidToken(self):
+        if self._creds.valid:
+            return True
+
+        if not self._creds.refresh_token:
+            logging.error("GMail token has expired and has no refresh "
+                          "token. Run with --reauthenticate.")
+            return False
+
+        if self._thread is None:
+            return self.refresh()
+
+        self._wakeup.set()
+        with self._refreshed:
+            self._refreshed.wait_for(lambda: self._creds.valid,
+                                     timeout=WAIT_FOR_TOKEN_SECONDS)
+
+        return self._creds.valid
+
+    # Save the credentials for the next run. The file is replaced
+    # atomically, so a crash never leaves a partial token file.
+
+    def writeToken(self):
+        directory = os.path.dirname(os.path.abspath(self._tokenfile))
+        try:
+            handle, tmpfilename = tempfile.mkstemp(dir=directory,
+                                                   suffix='.tmp')
+            with os.fdopen(handle, 'w') as token:
+                token.write(self._creds.to_json())
+
+            os.replace(tmpfilename, self._tokenfile)
+        except OSError as err:
+            logging.error(f"Cannot write file {self._tokenfile}: {err}")
+
+    # Without a refresh token there is nothing to refresh, and
+    # waitForValidToken fails when the token expires.
+
+    def refreshThreadFunction(self):
+        if not self._creds.refresh_token:
+            return
+
+        while not self._stop.is_set():
+            delay = self._secondsToExpiry() - REFRESH_MARGIN_SECONDS
+            if delay > 0:
+                self._wakeup.wait(None if delay == float('inf') else delay)
+                self._wakeup.clear()
+                if self._stop.is_set():
+                    break
+
+            if self.refresh() is False:
+                self._wakeup.wait(REFRESH_RETRY_SECONDS)
+                self._wakeup.clear()
+
+    # Seconds until the token expires. Tokens without an expiry never expire.
+
+    def _secondsToExpiry(self):
+        expiry = self._creds.expiry
+        if expiry is None:
+            return float('inf')
+
+        now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        return (expiry - now).total_seconds()
+
+
+# Wrapper function for refreshThreadFunction
+
+def refreshThreadFunction(obj):
+    obj.refreshThreadFunction()
@@ -0,0 +1,232 @@
+#
+# Copyright © 2022 Tingdahl ICT Management
+# Licenced under the MIT licence, see license.md
+#
+
+import json
+import logging
+import threading
+import time
+
+# Opt-in tracing of where the time goes for each message (--trace).
+#
+# The processing wraps each stage of a message in a span:
+#
+#    with tracer.span('fetch'):
+#        ...
+#
+# When tracing is enabled, the spans are written to a Chrome trace file as
+# they end, so a long run does not keep them in memory. The file can be
+# opened in chrome://tracing or https://ui.perfetto.dev. Only the time per
+# stage and thread is kept, and logged at the end of the run. When tracing
+# is disabled, span() returns a context manager that does nothing.
+#
+# Each thread gets its own track in the trace. Threads are numbered in the
+# order of their first span, as thread idents are reused when the threads of
+# a retry pass replace the previous ones.
+
+STAGE = 'stage'
+MESSAGE = 'message'
+
+TRACE_HEAD = b'{"traceEvents": [\n'
+
+# Closes the list of events, and the object of the trace file
+TRACE_TAIL = b'\n],\n"displayTimeUnit": "ms"}\n'
+
+_enabled = False
+_filename = None
+_starttime = time.perf_counter()
+_lock = threading.Lock()
+_file = None
+_tailpos = None
+_nrevents = 0
+_nrspans = 0
+_nrthreads = 0
+_threads = threading.local()
+_stagetotals = {}
+_threadtotals = {}
+
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_NOSPAN = _NoSpan()
+
+
+# A span that is recorded when it ends
+class _Span:
+    __slots__ = '_name', '_category', '_args', '_start'
+
+    def __init__(self, name, category, args):
+        self._name = name
+        self._category = category
+        self._args = args
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        _record(self._name, self._category, self._start,
+                time.perf_counter() - self._start, self._args)
+        return False
+
+
+# Start writing the trace file. Returns False if it cannot be created.
+def enable(filename):
+    global _enabled, _filename, _file
+    try:
+        _file = open(filename, 'wb')
+        _file.write(TRACE_HEAD)
+    except OSError as err:
+        logging.error(f"Cannot write trace file {filename}: {err}")
+        return False
+
+    _enabled = True
+    _filename = filename
+    return True
+
+
+def isEnabled():
+    return _enabled
+
+
+# Returns a context manager that records a span for a stage of a message.
+# category is STAGE for the stages, and MESSAGE for the span around all
+# stages of a message.
+
+def span(name, category=STAGE, args=None):
+    if not _enabled:
+        return _NOSPAN
+
+    return _Span(name, category, args)
+
+
+# Returns the track number of the current thread, and its name
+def _currentThread():
+    global _nrthreads
+    track = getattr(_threads, 'track', None)
+    if track is None:
+        with _lock:
+            _nrthreads += 1
+            track = _nrthreads
+
+        _threads.track = track
+        _writeEvent({'name': 'thread_name', 'ph': 'M', 'pid': 1,
+                     'tid': track,
+                     'args': {'name': threading.current_thread().name}})
+
+    return track, threading.current_thread().name
+
+
+# Add the duration of a span to the totals, and write it to the trace file
+def _record(name, category, start, duration, args):
+    global _nrspans
+    track, threadname = _currentThread()
+    event = {'name': name, 'cat': category, 'ph': 'X', 'pid': 1,
+             'tid': track,
+             'ts': round((start - _starttime) * 1e6),
+             'dur': round(duration * 1e6)}
+    if args:
+        event['args'] = args
+
+    with _lock:
+        _nrspans += 1
+        if category == STAGE:
+            _stagetotals[name] = _stagetotals.get(name, 0) + duration
+            threadtotal = _threadtotals.setdefault(threadname, {})
+            threadtotal[name] = threadtotal.get(name, 0) + duration
+
+    _writeEvent(event)
+
+
+# Append an event to the trace file. If the file was closed by writeTrace,
+# the event is written over the closing bracket, which is written again by
+# the next writeTrace. After a write error, no more events are written.
+
+def _writeEvent(event):
+    global _file, _tailpos, _nrevents
+    data = json.dumps(event).encode()
+    with _lock:
+        if _file is None:
+            return
+
+        try:
+            if _tailpos is not None:
+                _file.seek(_tailpos)
+                _file.truncate()
+                _tailpos = None
+
+            if _nrevents:
+                _file.write(b',\n')
+            _file.write(data)
+            _nrevents += 1
+        except OSError as err:
+            logging.error(f"Cannot write trace file {_filename}: {err}")
+            _file.close()
+            _file = None
+
+
+# Close the list of events, so the trace file can be opened. Spans that end
+# later are still added to it.
+
+def writeTrace():
+    global _tailpos
+    if not _enabled:
+        return True
+
+    with _lock:
+        if _file is None:
+            return False
+
+        try:
+            if _tailpos is None:
+                _tailpos = _file.tell()
+                _file.write(TRACE_TAIL)
+            _file.flush()
+        except OSError as err:
+            logging.error(f"Cannot write trace file {_filename}: {err}")
+            return False
+
+        nrspans = _nrspans
+
+    logging.info(f"Wrote {nrspans} spans to {_filename}.")
+    return True
+
+
+# Log the time of each stage, and its share of the time of all stages. Per
+# thread, the same is logged on one line.
+
+def logSummary():
+    if not _enabled:
+        return
+
+    with _lock:
+        total = dict(_stagetotals)
+        perthread = {name: dict(threadtotal)
+                     for name, threadtotal in _threadtotals.items()}
+
+    alltime = sum(total.values())
+    if alltime == 0:
+        return
+
+    logging.info("Time per stage:")
+    for name, duration in sorted(total.items(), key=lambda item: -item[1]):
+        logging.info(f"  {name:16} {duration:10.1f} s "
+                     f"{100 * duration / alltime:5.1f}%")
+
+    logging.info("Time per stage and thread:")
+    for threadname, threadtotal in sorted(perthread.items()):
+        threadtime = sum(threadtotal.values())
+        shares = ', '.join(
+            f"{name} {100 * duration / threadtime:.0f}%"
+            for name, duration in sorted(threadtotal.items(),
+                                         key=lambda item: -item[1]))
+        logging.info(f"  {threadname}: {threadtime:.1f} s ({shares})")
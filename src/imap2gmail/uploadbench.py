@@ -0,0 +1,82 @@
+#
+# Copyright © 2022 Tingdahl ICT Management
+# Licenced under the MIT licence, see license.md
+#
+
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+from base64 import urlsafe_b64encode
+from .uploadbody import multipartBody
+
+# Microbenchmark of building the body of an import request, without sending
+# it. Compares the JSON body with the message as base64 ('raw'), as the
+# service builds it, with the multipart media upload of uploadbody.py.
+# Reports the CPU time and the peak of allocated memory per MB of message.
+#
+#    python -m imap2gmail.uploadbench --size_mb 10 --iterations 20
+
+LABELS = {'labelIds': ['INBOX', 'UNREAD', 'Label_1']}
+
+
+# The request body as googleapiclient builds it for {'raw': ...}
+def jsonBody(raw):
+    body = dict(LABELS)
+    body['raw'] = urlsafe_b64encode(raw).decode()
+    return json.dumps(body).encode()
+
+
+def rawBody(raw):
+    return multipartBody(LABELS, raw)[0]
+
+
+# Returns the CPU seconds and the peak of allocated bytes of building the
+# body iterations times. The first build is not measured, so the buffer of
+# rawBody is already allocated, as it is after the first message of a run.
+
+def measure(build, raw, iterations):
+    build(raw)
+
+    tracemalloc.start()
+    start = time.process_time()
+    for _ in range(iterations):
+        build(raw)
+
+    seconds = time.process_time() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return seconds, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size_mb", type=float, default=10,
+                        help="Size of the message in MB. Default is 10.")
+    parser.add_argument("--iterations", type=int, default=20,
+                        help="Number of bodies to build. Default is 20.")
+    args = parser.parse_args()
+
+    megabytes = args.size_mb
+    raw = os.urandom(int(megabytes * 1024 * 1024))
+
+    results = {}
+    for name, build in (('json', jsonBody), ('raw', rawBody)):
+        seconds, peak = measure(build, raw, args.iterations)
+        results[name] = {
+            'cpu_ms_per_mb': 1000 * seconds / args.iterations / megabytes,
+            'peak_mb_per_mb': peak / 1024 / 1024 / megabytes}
+
+    for name, result in results.items():
+        print(f"{name:5} {result['cpu_ms_per_mb']:8.2f} ms CPU per MB, "
+              f"{result['peak_mb_per_mb']:6.2f} MB allocated per MB")
+
+    return results
+
+
+if __name__ == "__main__":
+    main()
+    sys.exit(0)
@@ -0,0 +1,81 @@
+#
+# Copyright © 2022 Tingdahl ICT Management
+# Licenced under the MIT licence, see license.md
+#
+
+import json
+import os
+import threading
+from .scheduler import LARGE_MESSAGE_BYTES
+
+# Builds the body of a GMail media upload from the raw RFC822 bytes.
+#
+# Sending a message as {'raw': base64} in a JSON body makes four copies of
+# it: the base64 bytes, the str they are decoded to, the JSON text and the
+# encoded request. A media upload sends the message as it is. The metadata
+# (the labels) and the message are written into a multipart/related body in
+# a buffer that each thread reuses, so the message is copied once and
+# nothing is encoded.
+
+MULTIPART_CONTENT_TYPE = 'multipart/related; boundary="{}"'
+MESSAGE_CONTENT_TYPE = 'message/rfc822'
+
+# Buffers grow in steps of this size, so a slightly larger message does not
+# allocate a new buffer
+BUFFER_STEP = 1024 * 1024
+
+_buffers = threading.local()
+
+
+# Returns a random boundary that is not in the message
+def createBoundary(raw):
+    while True:
+        boundary = b'imap2gmail_' + os.urandom(16).hex().encode()
+        if raw.find(boundary) < 0:
+            return boundary
+
+
+# Returns the buffer of the current thread, with at least size bytes. A
+# smaller buffer is replaced, not resized, as the previous request may still
+# hold a view of it. Large messages get a buffer of their own, as only a few
+# of them are uploaded at the same time (see scheduler.py), and each thread
+# would otherwise keep a buffer of the largest message for the whole run.
+
+def threadBuffer(size):
+    if size > LARGE_MESSAGE_BYTES:
+        return bytearray(size)
+
+    buffer = getattr(_buffers, 'buffer', None)
+    if buffer is None or len(buffer) < size:
+        buffer = bytearray((size // BUFFER_STEP + 1) * BUFFER_STEP)
+        _buffers.buffer = buffer
+
+    return buffer
+
+
+# Write metadata (a dict, sent as JSON) and the raw message as a
+# multipart/related body into the buffer of the thread. Returns a view of
+# the body, and its content type. The view is valid until the thread builds
+# the next body.
+
+def multipartBody(metadata, raw):
+    boundary = createBoundary(raw)
+    head = b'--' + boundary + \
+        b'\r\nContent-Type: application/json; charset=UTF-8\r\n\r\n' + \
+        json.dumps(metadata).encode() + \
+        b'\r\n--' + boundary + \
+        b'\r\nContent-Type: ' + MESSAGE_CONTENT_TYPE.encode() + \
+        b'\r\n\r\n'
+    tail = b'\r\n--' + boundary + b'--\r\n'
+
+    # Written through a memoryview, as assigning bytes to a slice of a
+    # bytearray makes a temporary copy of them
+    size = len(head) + len(raw) + len(tail)
+    body = memoryview(threadBuffer(size))[:size]
+    end = len(head)
+    body[0:end] = head
+    body[end:end + len(raw)] = raw
+    end += len(raw)
+    body[end:size] = tail
+
+    return body, MULTIPART_CONTENT_TYPE.format(boundary.decode())
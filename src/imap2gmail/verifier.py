@@ -0,0 +1,228 @@
+#
+# Copyright © 2022 Tingdahl ICT Management
+# Licenced under the MIT licence, see license.md
+#
+
+import logging
+import os
+import sqlite3
+import threading
+
+# Labels that are not compared, as they change when the user reads or stars
+# a message in GMail after the import.
+IGNORED_LABELS = frozenset(('UNREAD', 'STARRED'))
+
+# Maximum number of messages of each kind that are listed in the report
+MAX_REPORTED_MESSAGES = 1000
+
+
+# Compares the messages in the source with the messages in GMail, by their
+# Message-ID header.
+#
+# The Message-ID and expected labels of each message in the source, and the
+# Message-ID and labels of each message in GMail, are stored in an sqlite
+# index file, so large mailboxes are not held in memory. The report is made
+# by joining the two. A message in the source is:
+#
+# - missing, if no message in GMail has its Message-ID
+# - mislabeled, if none of the messages in GMail with its Message-ID has all
+#   expected labels
+#
+# Messages are listed in GMail by the labels of the folders, so a missing
+# message may still be in GMail without any of them. The Message-IDs of the
+# missing messages are therefore searched for in all mail, and only messages
+# that the search does not find either are confirmed missing.
+#
+# A Message-ID is duplicated if GMail has more messages with it than the
+# source has. Messages without Message-ID cannot be verified, and are only
+# counted.
+
+class Verifier:
+    __slots__ = '_filename', '_connection', '_lock'
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._connection = None
+        self._lock = threading.Lock()
+
+    # Create an empty index file
+    def open(self):
+        try:
+            if os.path.exists(self._filename):
+                os.remove(self._filename)
+
+            self._connection = sqlite3.connect(self._filename,
+                                               check_same_thread=False)
+            self._connection.executescript("""
+                CREATE TABLE source (folder TEXT, id, messageid TEXT,
+                                     labels TEXT);
+                CREATE TABLE gmail (gmailid TEXT PRIMARY KEY, messageid TEXT,
+                                    labels TEXT);
+                CREATE INDEX source_messageid ON source (messageid);
+                CREATE INDEX gmail_messageid ON gmail (messageid);
+                """)
+        except (OSError, sqlite3.Error) as err:
+            logging.error(f"Cannot create index file {self._filename}: {err}")
+            self._connection = None
+            return False
+
+        return True
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    # Add messages in a folder of the source. messages is a list of
+    # (id, Message-ID, expected label ids). The ids keep their type, so they
+    # can be queued again.
+
+    def addSourceMessages(self, folder, messages):
+        rows = [(folder, msgid, messageid, joinLabels(labels))
+                for msgid, messageid, labels in messages]
+        with self._lock:
+            self._connection.executemany(
+                "INSERT INTO source VALUES (?, ?, ?, ?)", rows)
+            self._connection.commit()
+
+    # Add a message in GMail. Called by GMailImapImporter's
+    # retrieveMessageHeaders.
+
+    def addGMailMessage(self, gmailid, messageid, labelids):
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO gmail VALUES (?, ?, ?)",
+                (gmailid, messageid, joinLabels(labelids)))
+
+    # Returns the Message-IDs of the source that are not in GMail
+    def missingMessageIDs(self):
+        with self._lock:
+            self._connection.commit()
+            return [messageid for messageid, in self._connection.execute(
+                "SELECT DISTINCT messageid FROM source "
+                "WHERE messageid IS NOT NULL AND messageid NOT IN "
+                "(SELECT messageid FROM gmail WHERE messageid IS NOT NULL)")]
+
+    # Compare the source with GMail. absent are the Message-IDs that a search
+    # of all mail did not find. Returns the report, and the confirmed missing
+    # messages as (folder, id) tuples.
+
+    def createReport(self, absent=frozenset()):
+        with self._lock:
+            self._connection.commit()
+            cursor = self._connection.cursor()
+
+            perfolder = {}
+            for folder, count in cursor.execute(
+                    "SELECT folder, COUNT(*) FROM source GROUP BY folder"):
+                perfolder[folder] = {'messages': count, 'verified': 0,
+                                     'missing': 0, 'mislabeled': 0,
+                                     'no_message_id': 0}
+
+            nomessageid = []
+            for folder, msgid in cursor.execute(
+                    "SELECT folder, id FROM source WHERE messageid IS NULL"):
+                perfolder[folder]['no_message_id'] += 1
+                nomessageid.append({'folder': folder, 'id': msgid})
+
+            missing = []
+            for folder, msgid, messageid in cursor.execute(
+                    "SELECT folder, id, messageid FROM source "
+                    "WHERE messageid IS NOT NULL AND messageid NOT IN "
+                    "(SELECT messageid FROM gmail "
+                    " WHERE messageid IS NOT NULL)"):
+                perfolder[folder]['missing'] += 1
+                missing.append({'folder': folder, 'id': msgid,
+                                'message_id': messageid,
+                                'confirmed': messageid in absent})
+
+            mislabeled = []
+            for folder, msgid, messageid, labels, gmaillabels in \
+                    cursor.execute(
+                        "SELECT s.folder, s.id, s.messageid, s.labels, "
+                        "GROUP_CONCAT(g.labels, '|') "
+                        "FROM source s JOIN gmail g USING (messageid) "
+                        "GROUP BY s.rowid"):
+                expected = splitLabels(labels) - IGNORED_LABELS
+                copies = [splitLabels(copy)
+                          for copy in gmaillabels.split('|')]
+                if any(expected <= copy for copy in copies):
+                    perfolder[folder]['verified'] += 1
+                    continue
+
+                perfolder[folder]['mislabeled'] += 1
+                mislabeled.append({'folder': folder, 'id': msgid,
+                                   'message_id': messageid,
+                                   'expected_labels': sorted(expected),
+                                   'gmail_labels': [sorted(copy)
+                                                    for copy in copies]})
+
+            duplicates = []
+            for messageid, sourcecopies, gmailcopies, gmailids in \
+                    cursor.execute(
+                        "SELECT g.messageid, "
+                        "(SELECT COUNT(*) FROM source s "
+                        " WHERE s.messageid = g.messageid), "
+                        "COUNT(*), GROUP_CONCAT(g.gmailid) "
+                        "FROM gmail g WHERE g.messageid IN "
+                        "(SELECT messageid FROM source) "
+                        "GROUP BY g.messageid"):
+                if gmailcopies > sourcecopies:
+                    duplicates.append({'message_id': messageid,
+                                       'source_copies': sourcecopies,
+                                       'gmail_copies': gmailcopies,
+                                       'gmail_ids': gmailids.split(',')})
+
+            nrgmail = cursor.execute(
+                "SELECT COUNT(*) FROM gmail").fetchone()[0]
+
+        totals = {'messages': 0, 'verified': 0, 'missing': 0,
+                  'mislabeled': 0, 'no_message_id': 0}
+        for item in perfolder.values():
+            for key in totals:
+                totals[key] += item[key]
+
+        totals['unconfirmed_missing'] = \
+            sum(1 for item in missing if not item['confirmed'])
+        totals['duplicated'] = len(duplicates)
+        totals['gmail_messages'] = nrgmail
+
+        report = {'totals': totals,
+                  'folders': perfolder,
+                  'missing': missing[:MAX_REPORTED_MESSAGES],
+                  'mislabeled': mislabeled[:MAX_REPORTED_MESSAGES],
+                  'duplicates': duplicates[:MAX_REPORTED_MESSAGES],
+                  'no_message_id': nomessageid[:MAX_REPORTED_MESSAGES]}
+
+        return report, [(item['folder'], item['id']) for item in missing
+                        if item['confirmed']]
+
+
+def joinLabels(labelids):
+    return ','.join(sorted(labelids))
+
+
+def splitLabels(labels):
+    return set(labels.split(',')) if labels else set()
+
+
+# Log a short summary of the report
+def logReport(report):
+    totals = report['totals']
+    logging.info(f"Verify: {totals['verified']} of {totals['messages']} "
+                 f"messages are in GMail with the right labels.")
+
+    if totals['missing'] or totals['mislabeled'] or totals['duplicated']:
+        logging.warning(f"Verify: {totals['missing']} missing, "
+                        f"{totals['mislabeled']} mislabeled, "
+                        f"{totals['duplicated']} Message-IDs duplicated "
+                        f"in GMail.")
+
+    if totals['unconfirmed_missing']:
+        logging.warning(f"Verify: {totals['unconfirmed_missing']} missing "
+                        f"messages could not be confirmed by a search of "
+                        f"all mail, and are only reported.")
+
+    if totals['no_message_id']:
+        logging.warning(f"Verify: {totals['no_message_id']} messages have "
+                        f"no Message-ID and cannot be verified.")
@@ -0,0 +1,158 @@
+#
+# Copyright © 2022 Tingdahl ICT Management
+# Licenced under the MIT licence, see license.md
+#
+
+import json
+import os
+import time
+from imap2gmail import cachewriter
+from imap2gmail.cachewriter import CacheWriter
+from imap2gmail.deadletters import DeadLetterList
+from imap2gmail.gmailimapimporter import GMailImportError
+from imap2gmail.imap2gmailprocessor import Imap2GMailProcessor
+from imap2gmail.imapreader import ImapMessageID, ImapMessageIDList
+from imap2gmail.messagereader import MessageReader
+
+
+def createWriter(filename):
+    cache = ImapMessageIDList()
+    cache.setFolders(['INBOX'])
+    return CacheWriter(cache, filename)
+
+
+def readCache(filename):
+    with open(filename) as file:
+        return sorted(item['id'] for item in json.load(file))
+
+
+# Wait until the cache file exists, or a second has passed
+def waitForFile(filename):
+    deadline = time.monotonic() + 1
+    while not os.path.exists(filename) and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    return os.path.exists(filename)
+
+
+def test_batch_is_written(tmp_path, monkeypatch):
+    monkeypatch.setattr(cachewriter, 'CACHE_WRITE_INTERVAL_SECONDS', 60)
+    monkeypatch.setattr(cachewriter, 'CACHE_WRITE_BATCH', 3)
+    filename = str(tmp_path / 'cache.json')
+    writer = createWriter(filename)
+    writer.start()
+
+    writer.add(ImapMessageID('INBOX', 1))
+    writer.add(ImapMessageID('INBOX', 2))
+    time.sleep(0.1)
+    assert not os.path.exists(filename)
+
+    writer.add(ImapMessageID('INBOX', 3))
+    assert waitForFile(filename)
+    assert readCache(filename) == [1, 2, 3]
+    writer.stop()
+
+
+def test_periodic_flush(tmp_path, monkeypatch):
+    monkeypatch.setattr(cachewriter, 'CACHE_WRITE_INTERVAL_SECONDS', 0.05)
+    filename = str(tmp_path / 'cache.json')
+    writer = createWriter(filename)
+    writer.start()
+
+    writer.add(ImapMessageID('INBOX', 1))
+    assert waitForFile(filename)
+    assert readCache(filename) == [1]
+    writer.stop()
+
+
+def test_failed_write_is_pending(tmp_path, monkeypatch):
+    writer = createWriter(str(tmp_path / 'cache.json'))
+    writer.add(ImapMessageID('INBOX', 1))
+    writer.add(ImapMessageID('INBOX', 2))
+
+    monkeypatch.setattr(ImapMessageIDList, 'writeJSonFile',
+                        lambda self, filename: False)
+    assert writer.flush() is False
+    assert writer._pending == 2
+
+    monkeypatch.undo()
+    assert writer.flush()
+    assert writer._pending == 0
+    assert readCache(str(tmp_path / 'cache.json')) == [1, 2]
+
+
+def test_file_is_replaced_atomically(tmp_path, monkeypatch):
+    filename = str(tmp_path / 'cache.json')
+    cache = ImapMessageIDList()
+    cache._foldersidslist = {'INBOX': {1}}
+    assert cache.writeJSonFile(filename)
+    assert not os.path.exists(filename + '.tmp')
+
+    # A write that fails before the rename leaves the file as it was
+    def replace(source, destination):
+        raise OSError("disk full")
+
+    cache._foldersidslist['INBOX'].add(2)
+    monkeypatch.setattr(os, 'replace', replace)
+    assert cache.writeJSonFile(filename) is False
+    assert readCache(filename) == [1]
+
+
+# Reader with one folder of three messages
+class FakeReader(MessageReader):
+    def isOK(self):
+        return True
+
+    def retrieveAllFolders(self):
+        return ['INBOX']
+
+    def setCurrentFolder(self, folder):
+        return True
+
+    def searchMessages(self, startdate, beforedate, includedeleted):
+        return [1, 2, 3]
+
+    def loadMessage(self, msgid, size=None):
+        return {b'FLAGS': (), b'RFC822': b'Subject: x\r\n\r\nbody',
+                b'UID': msgid}
+
+
+# Fails the first message, and imports the second one while the processor
+# is stopped as by a signal
+class FakeGMailClient:
+    def __init__(self):
+        self.processor = None
+
+    def isOK(self):
+        return True
+
+    def loadLabels(self):
+        return True
+
+    def addImapFolders(self, folders):
+        return True
+
+    def importImapMessage(self, message, folder):
+        if message[b'UID'] == 1:
+            return GMailImportError("Server error", 'http503', True)
+
+        self.processor._stopping.set()
+        return None
+
+
+def test_stopped_process_writes_cache_and_dead_letters(tmp_path):
+    cachefile = str(tmp_path / 'cache.json')
+    deadletterfile = str(tmp_path / 'failed.json')
+    gmailclient = FakeGMailClient()
+    processor = Imap2GMailProcessor(FakeReader, gmailclient, 1, None, None,
+                                    False, cachefile, None,
+                                    DeadLetterList(deadletterfile))
+    gmailclient.processor = processor
+
+    assert processor.discoverMessages()
+    assert processor.process() is False
+
+    assert readCache(cachefile) == [2]
+    deadletters = DeadLetterList(deadletterfile)
+    assert deadletters.loadJsonFile()
+    assert [m._id for m in deadletters.messageIDs()] == [1]
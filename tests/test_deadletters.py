@@ -0,0 +1,46 @@
+#
+# Copyright © 2022 Tingdahl ICT Management
+# Licenced under the MIT licence, see license.md
+#
+
+from imap2gmail.deadletters import FETCH_ERROR, DeadLetterList
+from imap2gmail.imapreader import ImapMessageID
+
+
+def test_round_trip(tmp_path):
+    filename = str(tmp_path / 'failed.json')
+    deadletters = DeadLetterList(filename)
+    deadletters.add(ImapMessageID('INBOX', 1), 'http429', 'rate', True)
+    deadletters.add(ImapMessageID('INBOX', 1), 'http503', 'server', True)
+    deadletters.add(ImapMessageID('Sent', 2), 'http400', 'bad', False)
+    assert deadletters.writeJsonFile()
+
+    loaded = DeadLetterList(filename)
+    assert loaded.loadJsonFile()
+    assert len(loaded) == 2
+
+    deadletter = loaded._deadletters[('INBOX', 1)]
+    assert deadletter._errorclass == 'http503'
+    assert deadletter._attempts == 2
+    assert deadletter._retryable
+
+    assert [(m._folder, m._id) for m in loaded.messageIDs(True)] == \
+        [('INBOX', 1)]
+    assert len(loaded.messageIDs()) == 2
+
+
+def test_remove():
+    deadletters = DeadLetterList(None)
+    deadletters.add(ImapMessageID('INBOX', 1), FETCH_ERROR, 'x', True)
+    deadletters.remove(ImapMessageID('INBOX', 1))
+    deadletters.remove(ImapMessageID('INBOX', 2))
+    assert len(deadletters) == 0
+    assert deadletters.writeJsonFile()
+
+
+def test_missing_and_broken_files(tmp_path):
+    assert DeadLetterList(str(tmp_path / 'none.json')).loadJsonFile()
+
+    broken = tmp_path / 'broken.json'
+    broken.write_text('[{')
+    assert DeadLetterList(str(broken)).loadJsonFile() is False
@@ -0,0 +1,211 @@
+#
+# Copyright © 2022 Tingdahl ICT Management
+# Licenced under the MIT licence, see license.md
+#
+
+import email.parser
+import json
+import urllib.parse
+import httplib2
+from googleapiclient.errors import HttpError
+from imap2gmail.gmailimapimporter import LOOKUP_QUERY_LENGTH, UPLOAD_URL, \
+    GMailImapImporter, GMailLabel, GMailLabels, lookupQueries
+
+
+class FakeTokenManager:
+    def waitForValidToken(self):
+        return True
+
+
+# Batch that answers each get from a dict of message id to a response, or
+# to the HTTP status of an error
+class FakeBatch:
+    def __init__(self, messages, callback):
+        self._messages = messages
+        self._callback = callback
+        self._ids = []
+
+    def add(self, request, request_id):
+        self._ids.append(request_id)
+
+    def execute(self, http):
+        for gmailid in self._ids:
+            message = self._messages[gmailid]
+            if isinstance(message, int):
+                self._callback(gmailid, None, HttpError(
+                    httplib2.Response({'status': message}), b''))
+            else:
+                self._callback(gmailid, message, None)
+
+
+class FakeRequest:
+    def __init__(self, result):
+        self._result = result
+
+    def execute(self, **kwargs):
+        return self._result
+
+
+class FakeService:
+    def __init__(self, messages):
+        self._messages = messages
+        self.batches = 0
+        self.queries = []
+
+    def new_batch_http_request(self, callback):
+        self.batches += 1
+        return FakeBatch(self._messages, callback)
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def get(self, **kwargs):
+        return None
+
+    # Search for rfc822msgid terms in the Message-IDs of the messages
+    def list(self, q, **kwargs):
+        self.queries.append(q)
+        terms = q.strip('{}').split()
+        return FakeRequest({'messages': [
+            {'id': gmailid} for gmailid, message in self._messages.items()
+            if isinstance(message, dict) and
+            f"rfc822msgid:{message['header']}" in terms]})
+
+
+def createImporter(monkeypatch, messages):
+    monkeypatch.setattr(GMailImapImporter, '_createHttp', lambda self: None)
+    monkeypatch.setattr(GMailImapImporter, '_waitForBatchRateLimit',
+                        lambda self: None)
+    monkeypatch.setattr(GMailImapImporter, '_waitForRateLimit',
+                        lambda self: None)
+    importer = GMailImapImporter()
+    importer._service = FakeService(messages)
+    importer._tokenmanager = FakeTokenManager()
+    return importer
+
+
+def test_headers_skip_messages_that_cannot_be_read(monkeypatch):
+    messages = {
+        'g1': {'id': 'g1', 'labelIds': ['INBOX'],
+               'payload': {'headers': [{'name': 'Message-Id',
+                                        'value': '<a@x>'}]}},
+        'g2': 404}
+    importer = createImporter(monkeypatch, messages)
+
+    found = []
+    assert importer._getMessageHeaders(
+        ['g1', 'g2'], lambda *args: found.append(args))
+    assert found == [('g1', '<a@x>', ['INBOX'])]
+    assert importer._service.batches == 1
+
+
+def test_headers_give_up_on_retryable_errors(monkeypatch):
+    importer = createImporter(monkeypatch, {'g1': 429})
+
+    assert importer._getMessageHeaders(['g1'], lambda *args: None) is False
+
+
+def createMessage(gmailid, messageid):
+    return {'id': gmailid, 'labelIds': ['CATEGORY_UPDATES'],
+            'header': messageid,
+            'payload': {'headers': [{'name': 'Message-ID',
+                                     'value': f"<{messageid}>"}]}}
+
+
+def test_lookup_queries():
+    messageids = [f"<{index}.abcdefghij@example.com>"
+                  for index in range(100)] + ['<a b@x>']
+    queries = list(lookupQueries(messageids))
+
+    assert all(len(query) <= LOOKUP_QUERY_LENGTH for query, _ in queries)
+    assert sorted(sum((group for _, group in queries), [])) == \
+        sorted(messageids)
+    assert ('rfc822msgid:a b@x', ['<a b@x>']) in queries
+    assert queries[0][0].startswith('{rfc822msgid:0.abcdefghij@example.com ')
+
+
+def test_lookup_message_ids(monkeypatch):
+    importer = createImporter(monkeypatch, {'g1': createMessage('g1', 'a@x'),
+                                            'g2': createMessage('g2', 'c@x')})
+
+    found = []
+    absent = importer.lookupMessageIDs(['<a@x>', '<b@x>', '<c@x>'],
+                                       lambda *args: found.append(args))
+    assert absent == {'<b@x>'}
+    assert sorted(gmailid for gmailid, _, _ in found) == ['g1', 'g2']
+    assert importer._service.queries == \
+        ['{rfc822msgid:a@x rfc822msgid:b@x rfc822msgid:c@x}']
+
+
+# Records the requests, and answers each with an empty message resource
+class FakeHttp:
+    def __init__(self):
+        self.requests = []
+
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        self.requests.append((uri, method, bytes(body), headers))
+        return httplib2.Response({'status': 200}), b'{"id": "m1"}'
+
+
+def createUploadImporter(monkeypatch):
+    http = FakeHttp()
+    monkeypatch.setattr(GMailImapImporter, '_createHttp', lambda self: http)
+    monkeypatch.setattr(GMailImapImporter, '_waitForRateLimit',
+                        lambda self: None)
+    importer = GMailImapImporter()
+    importer._tokenmanager = FakeTokenManager()
+    importer._labels = GMailLabels()
+    for name in ('INBOX', 'DRAFT', 'UNREAD', 'STARRED', 'SPAM', 'TRASH'):
+        importer._labels._labels.append(GMailLabel(name, name, name))
+
+    importer._inboxlabel, importer._draftlabel, importer._unreadlabel, \
+        importer._starredlabel, importer._junklabel, importer._trashlabel = \
+        importer._labels._labels
+    return importer, http
+
+
+def splitUri(uri):
+    path, _, query = uri.partition('?')
+    return path, dict(urllib.parse.parse_qsl(query))
+
+
+def test_import_upload_request(monkeypatch):
+    importer, http = createUploadImporter(monkeypatch)
+    raw = b'Subject: x\r\n\r\nbody'
+
+    assert importer.importImapMessage({b'FLAGS': (b'\\Flagged',),
+                                       b'RFC822': raw}, 'INBOX') is None
+
+    uri, method, body, headers = http.requests[0]
+    assert method == 'POST'
+    assert splitUri(uri) == (UPLOAD_URL + 'messages/import',
+                             {'uploadType': 'multipart',
+                              'internalDateSource': 'dateHeader',
+                              'processForCalendar': 'false',
+                              'neverMarkSpam': 'true'})
+
+    message = email.parser.BytesParser().parsebytes(
+        b'Content-Type: ' + headers['content-type'].encode() +
+        b'\r\n\r\n' + body)
+    assert message.get_content_type() == 'multipart/related'
+    metadata, rfc822 = message.get_payload()
+    assert json.loads(metadata.get_payload()) == \
+        {'labelIds': ['INBOX', 'UNREAD', 'STARRED']}
+    assert raw in body
+
+
+def test_draft_upload_request(monkeypatch):
+    importer, http = createUploadImporter(monkeypatch)
+    raw = b'Subject: draft\r\n\r\nbody'
+
+    assert importer.importImapMessage({b'FLAGS': (), b'RFC822': raw},
+                                      'DRAFT') is None
+
+    uri, method, body, headers = http.requests[0]
+    assert method == 'POST'
+    assert splitUri(uri) == (UPLOAD_URL + 'drafts', {'uploadType': 'media'})
+    assert headers['content-type'] == 'message/rfc822'
+    assert body == raw
@@ -0,0 +1,87 @@
+#
+# Copyright © 2022 Tingdahl ICT Management
+# Licenced under the MIT licence, see license.md
+#
+
+import threading
+import time
+import pytest
+from imap2gmail import governor
+from imap2gmail.governor import ByteRate, ThreadGate, isInPeriod, parseRate
+
+
+def test_parse_rate():
+    assert parseRate(None) is None
+    assert parseRate('unlimited') is None
+    assert parseRate(0) is None
+    assert parseRate(1000) == 1000
+    assert parseRate('512k') == 512 * 1024
+    assert parseRate(' 2M ') == 2 * 1024 * 1024
+    assert parseRate('1.5g') == 1.5 * 1024 * 1024 * 1024
+
+    with pytest.raises(ValueError):
+        parseRate('fast')
+    with pytest.raises(ValueError):
+        parseRate('-1k')
+
+
+def test_is_in_period():
+    def at(text):
+        return governor.parseTime(text)
+
+    assert isInPeriod(at('09:00'), at('08:00'), at('18:00'))
+    assert not isInPeriod(at('18:00'), at('08:00'), at('18:00'))
+    assert isInPeriod(at('23:00'), at('22:00'), at('06:00'))
+    assert isInPeriod(at('05:59'), at('22:00'), at('06:00'))
+    assert not isInPeriod(at('12:00'), at('22:00'), at('06:00'))
+
+
+def test_byte_rate(monkeypatch):
+    monkeypatch.setattr(governor, 'BURST_SECONDS', 0)
+    rate = ByteRate()
+    assert rate.take(10 ** 9) == 0
+
+    rate.setRate(10000)
+    assert rate.take(500) > 0.03
+
+    # Bytes that are given back are not waited for
+    rate.take(-500)
+    assert rate.take(100) < 0.03
+
+
+def test_byte_rate_change_wakes_waiting_threads(monkeypatch):
+    monkeypatch.setattr(governor, 'BURST_SECONDS', 0)
+    rate = ByteRate()
+    rate.setRate(100)
+
+    # Takes 10 seconds at the first rate
+    thread = threading.Thread(target=rate.take, args=(1000,))
+    start = time.monotonic()
+    thread.start()
+    time.sleep(0.1)
+    rate.setRate(None)
+    thread.join(5)
+
+    assert not thread.is_alive()
+    assert time.monotonic() - start < 5
+
+
+def test_thread_gate():
+    gate = ThreadGate()
+    gate.setLimit(1)
+    entered = threading.Event()
+
+    def enter():
+        with gate:
+            entered.set()
+
+    with gate:
+        thread = threading.Thread(target=enter)
+        thread.start()
+        assert not entered.wait(0.1)
+
+        # Raising the limit lets the waiting thread in
+        gate.setLimit(2)
+        assert entered.wait(5)
+
+    thread.join()
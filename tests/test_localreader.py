@@ -0,0 +1,130 @@
+#
+# Copyright © 2022 Tingdahl ICT Management
+# Licenced under the MIT licence, see license.md
+#
+
+import datetime
+import os
+import pytest
+from imap2gmail.localreader import MaildirReader, MboxArchive, MboxReader, \
+    buildMboxIndex, isInDateRange, maildirFlagsToImap, parseFromLineDate, \
+    parseMboxFlags
+from imap2gmail.messagereader import MessageReader
+
+MBOX = (b'From a@example.com Wed Jan  5 10:00:00 2022\n'
+        b'Subject: one\n'
+        b'Status: RO\n'
+        b'\n'
+        b'first\n'
+        b'\n'
+        b'From b@example.com Thu Jan  6 10:00:00 2022\n'
+        b'Subject: two\n'
+        b'X-Status: F\n'
+        b'\n'
+        b'>From the start\n'
+        b'>>From quoted\n'
+        b'\n'
+        b'From c@example.com Fri Jan  7 10:00:00 2022\n'
+        b'Subject: three\n'
+        b'X-Status: D\n'
+        b'\n'
+        b'last\n')
+
+
+def openMbox(tmp_path, content=MBOX):
+    filename = tmp_path / 'Archive.mbox'
+    filename.write_bytes(content)
+    reader = MboxReader(MboxArchive(str(filename)))
+    assert reader.retrieveAllFolders() == ['Archive']
+    assert reader.setCurrentFolder('Archive')
+    return reader
+
+
+def test_mbox_index(tmp_path):
+    filename = tmp_path / 'mbox'
+    filename.write_bytes(MBOX)
+    index = buildMboxIndex(str(filename))
+
+    assert len(index) == 4
+    assert index[0] == 0
+    assert MBOX[index[1]:].startswith(b'From b@')
+    assert MBOX[index[2]:].startswith(b'From c@')
+    assert index[3] == len(MBOX)
+
+
+def test_mbox_bodies(tmp_path):
+    reader = openMbox(tmp_path)
+
+    # The separating empty line is removed from all but the last message,
+    # which ends where the file ends
+    assert reader.loadMessage(1)[b'RFC822'] == \
+        b'Subject: one\nStatus: RO\n\nfirst\n'
+    assert reader.loadMessage(2)[b'RFC822'].endswith(b'>From quoted\n')
+    assert reader.loadMessage(3)[b'RFC822'] == \
+        b'Subject: three\nX-Status: D\n\nlast\n'
+    assert reader.loadMessage(0) is None
+    assert reader.loadMessage(4) is None
+
+
+def test_mbox_unquotes_from_lines(tmp_path):
+    reader = openMbox(tmp_path)
+    assert reader.loadMessage(2)[b'RFC822'] == \
+        b'Subject: two\nX-Status: F\n\nFrom the start\n>From quoted\n'
+
+
+def test_mbox_flags_and_search(tmp_path):
+    reader = openMbox(tmp_path)
+
+    assert reader.loadMessage(1)[b'FLAGS'] == (b'\\Seen',)
+    assert reader.loadMessage(2)[b'FLAGS'] == (b'\\Flagged',)
+
+    assert reader.searchMessages(None, None, True) == [1, 2, 3]
+    assert reader.searchMessages(None, None, False) == [1, 2]
+    assert reader.searchMessages(datetime.datetime(2022, 1, 6), None,
+                                 True) == [2, 3]
+
+    info = reader.fetchMessageInfo([1, 3])
+    assert info[1] == (MBOX.index(b'From b@'),
+                       datetime.datetime(2022, 1, 5, 10))
+    assert info[3][1] == datetime.datetime(2022, 1, 7, 10)
+
+
+def test_parse_helpers():
+    assert parseFromLineDate(b'From x Wed Jan  5 10:00:00 2022') == \
+        datetime.datetime(2022, 1, 5, 10)
+    assert parseFromLineDate(b'From x') is None
+    assert parseMboxFlags(b'Status: R\nX-Status: AD') == \
+        (b'\\Seen', b'\\Answered', b'\\Deleted')
+    assert maildirFlagsToImap('FSa', {'a': b'Junk'}) == \
+        (b'\\Flagged', b'\\Seen', b'Junk')
+    assert isInDateRange(None, datetime.datetime(2022, 1, 1), None)
+    assert not isInDateRange(datetime.datetime(2022, 1, 1), None,
+                             datetime.datetime(2022, 1, 1))
+
+
+def test_maildir_tree(tmp_path):
+    for maildir in ('', '.Sent', '.Archive.2020'):
+        for subdir in ('cur', 'tmp'):
+            os.makedirs(tmp_path / maildir / subdir)
+
+    (tmp_path / '.Sent' / 'cur' / '1.host:2,FS').write_bytes(b'Subject: x\n')
+    (tmp_path / '.Sent' / 'cur' / '2.host:2,T').write_bytes(b'Subject: y\n')
+
+    reader = MaildirReader(str(tmp_path))
+    assert reader.retrieveAllFolders() == ['Archive.2020', 'INBOX', 'Sent']
+    assert reader.setCurrentFolder('Sent')
+    assert reader.searchMessages(None, None, False) == ['1.host']
+    assert reader.searchMessages(None, None, True) == ['1.host', '2.host']
+
+    message = reader.loadMessage('1.host')
+    assert message[b'RFC822'] == b'Subject: x\n'
+    assert message[b'FLAGS'] == (b'\\Flagged', b'\\Seen')
+
+
+def test_incomplete_reader_cannot_be_created():
+    class Incomplete(MessageReader):
+        def isOK(self):
+            return True
+
+    with pytest.raises(TypeError):
+        Incomplete()
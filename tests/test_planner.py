@@ -0,0 +1,87 @@
+#
+# Copyright © 2022 Tingdahl ICT Management
+# Licenced under the MIT licence, see license.md
+#
+
+import pytest
+from imap2gmail.gmailimapimporter import MAX_CALLS_PER_SECOND, \
+    QUOTA_UNITS_DRAFT, QUOTA_UNITS_IMPORT, QUOTA_UNITS_LABEL
+from imap2gmail.imapreader import ImapMessageID, ImapMessageIDList
+from imap2gmail.planner import THREAD_BYTES_PER_SECOND, createPlan, \
+    uploadSize
+
+NOLIMITS = {'download_rate': None, 'upload_rate': None, 'threads': None}
+MB = 1024 * 1024
+
+
+class FakeGMailClient:
+    def isDraftFolder(self, folder):
+        return folder == 'Drafts'
+
+    def missingLabels(self, folders):
+        return ['Archive']
+
+
+def createMessages(sizes):
+    return [ImapMessageID(folder, msgid, size)
+            for folder, msgid, size in sizes]
+
+
+def test_cached_pending_drafts_and_labels():
+    messages = createMessages([('INBOX', 1, 100), ('INBOX', 2, 200),
+                               ('Drafts', 3, 50), ('Archive', 4, None)])
+    cache = ImapMessageIDList()
+    cache._foldersidslist = {'INBOX': {1}}
+
+    plan = createPlan(messages, ['INBOX', 'Drafts', 'Archive'], cache,
+                      FakeGMailClient(), 4, NOLIMITS, True)
+
+    totals = plan['totals']
+    assert totals['messages'] == 4
+    assert totals['cached'] == 1
+    assert totals['pending'] == 3
+    assert totals['bytes'] == 350
+    assert totals['pending_bytes'] == 250
+    assert totals['upload_bytes'] == sum(uploadSize(size)
+                                         for size in (200, 50, 0))
+    assert totals['messages_with_unknown_size'] == 1
+    assert totals['labels_to_create'] == 1
+    assert totals['api_calls'] == 4
+    assert totals['quota_units'] == 2 * QUOTA_UNITS_IMPORT + \
+        QUOTA_UNITS_DRAFT + QUOTA_UNITS_LABEL
+    assert plan['labels_to_create'] == ['Archive']
+
+    folders = plan['folders']
+    assert folders['Drafts']['drafts']
+    assert folders['Drafts']['quota_units'] == QUOTA_UNITS_DRAFT
+    assert folders['INBOX']['cached'] == 1
+
+    # Small messages are limited by the rate limiter
+    assert plan['bound_by'] == 'rate limit'
+    assert plan['estimated_seconds'] == \
+        pytest.approx(4 / MAX_CALLS_PER_SECOND)
+
+
+def test_large_messages_are_limited_by_bandwidth():
+    messages = createMessages([('INBOX', msgid, 20 * MB)
+                               for msgid in range(10)])
+    uploadbytes = 10 * uploadSize(20 * MB)
+
+    plan = createPlan(messages, ['INBOX'], ImapMessageIDList(),
+                      FakeGMailClient(), 4, NOLIMITS, True)
+    assert plan['bound_by'] == 'thread throughput'
+    assert plan['estimated_seconds'] == pytest.approx(
+        (200 * MB + uploadbytes) / (4 * THREAD_BYTES_PER_SECOND))
+
+    # Messages from a local archive are not downloaded
+    plan = createPlan(messages, ['INBOX'], ImapMessageIDList(),
+                      FakeGMailClient(), 4, NOLIMITS, False)
+    assert plan['estimated_seconds'] == pytest.approx(
+        uploadbytes / (4 * THREAD_BYTES_PER_SECOND))
+
+    limits = dict(NOLIMITS, upload_rate=64 * 1024)
+    plan = createPlan(messages, ['INBOX'], ImapMessageIDList(),
+                      FakeGMailClient(), 4, limits, True)
+    assert plan['bound_by'] == 'upload rate'
+    assert plan['estimated_seconds'] == pytest.approx(uploadbytes /
+                                                      (64 * 1024))
@@ -0,0 +1,74 @@
+#
+# Copyright © 2022 Tingdahl ICT Management
+# Licenced under the MIT licence, see license.md
+#
+
+import datetime
+from imap2gmail.imapreader import ImapMessageID
+from imap2gmail.scheduler import LARGE_MESSAGE_BYTES, \
+    MAX_CONCURRENT_LARGE_MESSAGES, PRIORITY_NEWEST, MessageScheduler
+
+LARGE = LARGE_MESSAGE_BYTES
+
+
+def createScheduler(messages, **kwargs):
+    scheduler = MessageScheduler(**kwargs)
+    for index, (size, date) in enumerate(messages):
+        scheduler.put(ImapMessageID('INBOX', index, size, date))
+
+    scheduler.schedule()
+    return scheduler
+
+
+def takeAll(scheduler):
+    result = []
+    while True:
+        messageid, largeslot = scheduler.get()
+        if messageid is None:
+            return result
+
+        result.append(messageid._id)
+        scheduler.done(largeslot)
+
+
+def test_largest_first_unknown_size_last():
+    scheduler = createScheduler([(10, None), (None, None), (30, None),
+                                 (20, None)])
+    assert scheduler.qsize() == 4
+    assert takeAll(scheduler) == [2, 3, 0, 1]
+    assert scheduler.qsize() == 0
+
+
+def test_large_messages_are_limited():
+    nrlarge = MAX_CONCURRENT_LARGE_MESSAGES + 2
+    scheduler = createScheduler([(LARGE + i, None) for i in range(nrlarge)] +
+                                [(100, None), (50, None)])
+
+    # Hold all large slots; the next threads take small messages
+    taken = [scheduler.get() for _ in range(MAX_CONCURRENT_LARGE_MESSAGES)]
+    assert all(largeslot for _, largeslot in taken)
+
+    messageid, largeslot = scheduler.get()
+    assert (messageid._id, largeslot) == (nrlarge, False)
+    messageid, largeslot = scheduler.get()
+    assert (messageid._id, largeslot) == (nrlarge + 1, False)
+
+    # Giving back a slot makes the next large message available
+    scheduler.done(True)
+    messageid, largeslot = scheduler.get()
+    assert messageid._size >= LARGE and largeslot
+
+
+def test_newest_windows_first_unknown_date_last():
+    newest = datetime.datetime(2022, 6, 30, 12)
+    day = datetime.timedelta(days=1)
+    scheduler = createScheduler([(10, newest - 40 * day),
+                                 (10, None),
+                                 (5, newest),
+                                 (50, newest - 10 * day),
+                                 (20, newest - 45 * day)],
+                                priority=PRIORITY_NEWEST, windowdays=30)
+
+    assert [messageid._id for messageid in scheduler.messages()] == \
+        [3, 2, 4, 0, 1]
+    assert takeAll(scheduler) == [3, 2, 4, 0, 1]
@@ -0,0 +1,143 @@
+#
+# Copyright © 2022 Tingdahl ICT Management
+# Licenced under the MIT licence, see license.md
+#
+
+import os
+from imap2gmail.deadletters import SPOOL_ERROR, DeadLetterList
+from imap2gmail.imap2gmailprocessor import Imap2GMailProcessor
+from imap2gmail.imapreader import ImapMessageID
+from imap2gmail.localreader import MaildirReader
+from imap2gmail.messagereader import MessageReader
+from imap2gmail.spool import MessageSpool, SpoolReader, dirNameToFolder, \
+    folderToDirName, imapFlagsToMaildir, messageIdToUid, parseMaildirFileName
+
+
+# Reader with one folder of three messages
+class FakeReader(MessageReader):
+    def isOK(self):
+        return True
+
+    def retrieveAllFolders(self):
+        return ['INBOX/Sub.folder']
+
+    def setCurrentFolder(self, folder):
+        return True
+
+    def searchMessages(self, startdate, beforedate, includedeleted):
+        return [1, 2, 3]
+
+    def loadMessage(self, msgid, size=None):
+        return {b'FLAGS': (b'\\Seen',),
+                b'RFC822': f'Subject: {msgid}\r\n\r\nbody'.encode()}
+
+
+def test_folder_names_round_trip():
+    for folder in ('INBOX', 'INBOX.Sent', 'Archive/2020', 'a b%c'):
+        dirname = folderToDirName(folder)
+        assert '/' not in dirname
+        assert dirNameToFolder(dirname) == folder
+
+
+def test_flags_to_maildir():
+    assert imapFlagsToMaildir((b'\\Seen', b'\\Flagged', b'Junk',
+                               b'\\Recent')) == 'FSa'
+    assert imapFlagsToMaildir(()) == ''
+
+
+def test_parse_file_name():
+    assert parseMaildirFileName('12.host:2,FS') == (12, 'FS')
+    assert parseMaildirFileName('12.host') == (12, '')
+    assert parseMaildirFileName('dovecot-keywords') is None
+    assert parseMaildirFileName('s1%2EM2%2Ch.host:2,S') == ('1.M2,h', 'S')
+    assert parseMaildirFileName(
+        f"{messageIdToUid('1.M2:x/y')}.host:2,") == ('1.M2:x/y', '')
+
+
+def test_store_and_read_back(tmp_path):
+    spool = MessageSpool(str(tmp_path))
+    assert spool.setFolders(['INBOX.Sent'])
+
+    messageid = ImapMessageID('INBOX.Sent', 7)
+    assert spool.storeMessage(messageid, {b'FLAGS': (b'\\Seen', b'Junk'),
+                                          b'RFC822': b'Subject: x\r\n\r\n'})
+    assert spool.contains(messageid)
+    assert not spool.contains(ImapMessageID('INBOX.Sent', 8))
+
+    reader = SpoolReader(str(tmp_path))
+    assert reader.retrieveAllFolders() == ['INBOX.Sent']
+    assert reader.setCurrentFolder('INBOX.Sent')
+    assert reader.searchMessages(None, None, False) == [7]
+
+    message = reader.loadMessage(7)
+    assert message[b'RFC822'] == b'Subject: x\r\n\r\n'
+    assert set(message[b'FLAGS']) == {b'\\Seen', b'Junk'}
+
+    # Nothing is left behind in tmp/
+    maildir = os.path.join(str(tmp_path), folderToDirName('INBOX.Sent'))
+    assert os.listdir(os.path.join(maildir, 'tmp')) == []
+
+
+def test_failed_spool_write_is_a_dead_letter(tmp_path, monkeypatch):
+    spool = MessageSpool(str(tmp_path / 'spool'))
+    deadletters = DeadLetterList(str(tmp_path / 'failed.json'))
+    monkeypatch.setattr('imap2gmail.imap2gmailprocessor.RETRY_PASSES', 0)
+
+    original = MessageSpool.storeMessage
+
+    def storeMessage(self, messageid, imapmessage):
+        if messageid._id == 2:
+            return False
+
+        return original(self, messageid, imapmessage)
+
+    monkeypatch.setattr(MessageSpool, 'storeMessage', storeMessage)
+
+    processor = Imap2GMailProcessor(FakeReader, None, 1, None, None, False,
+                                    None, spool, deadletters)
+    assert processor.discoverMessages()
+    assert processor.process()
+
+    folder = 'INBOX/Sub.folder'
+    assert spool.contains(ImapMessageID(folder, 1))
+    assert not spool.contains(ImapMessageID(folder, 2))
+
+    failed = DeadLetterList(str(tmp_path / 'failed.json'))
+    assert failed.loadJsonFile()
+    assert [(m._folder, m._id) for m in failed.messageIDs()] == [(folder, 2)]
+    assert failed._deadletters[(folder, 2)]._errorclass == SPOOL_ERROR
+
+
+def test_maildir_source_ids_round_trip(tmp_path):
+    source = tmp_path / 'maildir'
+    for subdir in ('cur', 'new', 'tmp'):
+        (source / subdir).mkdir(parents=True)
+
+    # Two messages delivered in the same second, one that does not start
+    # with digits, and one with a name of digits only
+    names = ['1700000000.M1P10.host,S=20', '1700000000.M2P10.host,S=20',
+             'abc.host', '123']
+    for name in names:
+        (source / 'cur' / f"{name}:2,S").write_bytes(
+            f'Subject: {name}\r\n\r\nbody'.encode())
+
+    spooldir = str(tmp_path / 'spool')
+    spool = MessageSpool(spooldir)
+    processor = Imap2GMailProcessor(lambda: MaildirReader(str(source)), None,
+                                    1, None, None, False, None, spool)
+    assert processor.discoverMessages()
+    assert processor.process()
+
+    reader = SpoolReader(spooldir)
+    assert reader.setCurrentFolder('INBOX')
+    msgids = reader.searchMessages(None, None, False)
+    assert sorted(msgids) == sorted(names)
+    for name in names:
+        assert reader.loadMessage(name)[b'RFC822'].startswith(
+            f'Subject: {name}'.encode())
+
+    # A second fetch run finds all of them in the spool
+    spool = MessageSpool(spooldir)
+    assert spool.setFolders(['INBOX'])
+    assert all(spool.contains(ImapMessageID('INBOX', name))
+               for name in names)
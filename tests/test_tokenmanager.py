@@ -0,0 +1,52 @@
+#
+# Copyright © 2022 Tingdahl ICT Management
+# Licenced under the MIT licence, see license.md
+#
+
+import datetime
+import time
+from imap2gmail.tokenmanager import TokenManager
+
+
+# Credentials with an expiry and an optional refresh token
+class FakeCredentials:
+    def __init__(self, valid, refresh_token, expiry=None):
+        self.valid = valid
+        self.refresh_token = refresh_token
+        self.expiry = expiry
+        self.refreshes = 0
+
+    def refresh(self, request):
+        self.refreshes += 1
+        self.valid = True
+        self.expiry = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+
+    def to_json(self):
+        return '{}'
+
+
+def test_expired_token_without_refresh_token_fails_fast(tmp_path):
+    manager = TokenManager(FakeCredentials(False, None),
+                           str(tmp_path / 'token.json'))
+    manager.start()
+
+    start = time.monotonic()
+    assert manager.waitForValidToken() is False
+    assert time.monotonic() - start < 1
+
+    manager.stop()
+
+
+def test_expired_token_is_refreshed_once(tmp_path):
+    creds = FakeCredentials(False, 'refresh',
+                            datetime.datetime.utcnow())
+    manager = TokenManager(creds, str(tmp_path / 'token.json'))
+    manager.start()
+
+    assert manager.waitForValidToken()
+    assert manager.waitForValidToken()
+    assert creds.refreshes == 1
+    assert (tmp_path / 'token.json').exists()
+
+    manager.stop()
+    assert manager._thread is None
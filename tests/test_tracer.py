@@ -0,0 +1,53 @@
+#
+# Copyright © 2022 Tingdahl ICT Management
+# Licenced under the MIT licence, see license.md
+#
+
+import json
+import threading
+from imap2gmail import tracer
+
+
+def runSpans(name):
+    with tracer.span('message', tracer.MESSAGE, {'id': name}):
+        with tracer.span('fetch'):
+            pass
+        with tracer.span('upload'):
+            pass
+
+
+def test_trace_is_streamed_and_threads_get_own_tracks(tmp_path,
+                                                      monkeypatch):
+    for name in ('_enabled', '_filename', '_file', '_tailpos', '_nrevents',
+                 '_nrspans', '_nrthreads'):
+        monkeypatch.setattr(tracer, name, getattr(tracer, name))
+    monkeypatch.setattr(tracer, '_threads', threading.local())
+    monkeypatch.setattr(tracer, '_stagetotals', {})
+    monkeypatch.setattr(tracer, '_threadtotals', {})
+
+    filename = tmp_path / 'trace.json'
+    assert tracer.enable(str(filename))
+
+    # Two passes of threads with the same name, which may reuse idents
+    for _ in range(2):
+        thread = threading.Thread(target=runSpans, args=('a',),
+                                  name='process-0')
+        thread.start()
+        thread.join()
+
+    assert tracer.writeTrace()
+    events = json.loads(filename.read_text())['traceEvents']
+    assert len([e for e in events if e['ph'] == 'X']) == 6
+    assert sorted(e['tid'] for e in events if e['ph'] == 'M') == [1, 2]
+
+    # Spans after writeTrace are added, and the file is valid again after
+    # the next writeTrace
+    runSpans('b')
+    assert tracer.writeTrace()
+    events = json.loads(filename.read_text())['traceEvents']
+    assert len([e for e in events if e['ph'] == 'X']) == 9
+
+    assert set(tracer._stagetotals) == {'fetch', 'upload'}
+    assert set(tracer._threadtotals) == {'process-0',
+                                         threading.current_thread().name}
+    tracer._file.close()
@@ -0,0 +1,56 @@
+#
+# Copyright © 2022 Tingdahl ICT Management
+# Licenced under the MIT licence, see license.md
+#
+
+import email.parser
+import email.policy
+import json
+from imap2gmail.scheduler import LARGE_MESSAGE_BYTES
+from imap2gmail.uploadbody import BUFFER_STEP, MESSAGE_CONTENT_TYPE, \
+    multipartBody, threadBuffer
+
+RAW = b'From: a@example.com\r\nSubject: Test\r\n\r\nHello\r\n'
+
+
+def test_multipart_body():
+    body, contenttype = multipartBody({'labelIds': ['INBOX']}, RAW)
+
+    # Parse the body as the server would
+    message = email.parser.BytesParser(policy=email.policy.compat32) \
+        .parsebytes(b'Content-Type: ' + contenttype.encode() +
+                    b'\r\n\r\n' + bytes(body))
+    assert message.get_content_type() == 'multipart/related'
+
+    metadata, rfc822 = message.get_payload()
+    assert metadata.get_content_type() == 'application/json'
+    assert json.loads(metadata.get_payload()) == {'labelIds': ['INBOX']}
+    assert rfc822.get_content_type() == MESSAGE_CONTENT_TYPE
+
+    boundary = message.get_boundary().encode()
+    start = bytes(body).index(RAW)
+    assert bytes(body[start + len(RAW):]) == \
+        b'\r\n--' + boundary + b'--\r\n'
+    assert boundary not in RAW
+
+
+def test_buffer_is_reused():
+    body, _ = multipartBody({}, RAW)
+    first = threadBuffer(0)
+    body, _ = multipartBody({}, RAW * 2)
+    assert threadBuffer(0) is first
+
+    # A message larger than the buffer gets a new one
+    body, _ = multipartBody({}, b'x' * (len(first) + 1))
+    assert threadBuffer(0) is not first
+    assert len(threadBuffer(0)) % BUFFER_STEP == 0
+
+
+def test_large_messages_are_not_kept():
+    multipartBody({}, RAW)
+    first = threadBuffer(0)
+
+    body, _ = multipartBody({}, b'x' * LARGE_MESSAGE_BYTES)
+    assert body.obj is not first
+    assert len(body.obj) == len(body)
+    assert threadBuffer(0) is first
@@ -0,0 +1,72 @@
+#
+# Copyright © 2022 Tingdahl ICT Management
+# Licenced under the MIT licence, see license.md
+#
+
+from imap2gmail.verifier import Verifier
+
+
+def createVerifier(tmp_path):
+    verifier = Verifier(str(tmp_path / 'verify.sqlite'))
+    assert verifier.open()
+    verifier.addSourceMessages('INBOX', [
+        (1, '<a@x>', ['INBOX', 'UNREAD']),
+        (2, '<b@x>', ['INBOX']),
+        (3, '<c@x>', ['INBOX']),
+        (4, None, ['INBOX'])])
+    verifier.addSourceMessages('Work', [(5, '<d@x>', ['Label_1'])])
+    verifier.addGMailMessage('g1', '<a@x>', ['INBOX'])
+    verifier.addGMailMessage('g2', '<b@x>', ['Label_1'])
+    verifier.addGMailMessage('g3', '<d@x>', ['Label_1'])
+    verifier.addGMailMessage('g4', '<d@x>', ['Label_1', 'TRASH'])
+    return verifier
+
+
+def test_report(tmp_path):
+    verifier = createVerifier(tmp_path)
+    assert verifier.missingMessageIDs() == ['<c@x>']
+
+    report, missing = verifier.createReport()
+    verifier.close()
+
+    totals = report['totals']
+    assert totals['messages'] == 5
+    assert totals['verified'] == 2
+    assert totals['missing'] == 1
+    assert totals['mislabeled'] == 1
+    assert totals['no_message_id'] == 1
+    assert totals['duplicated'] == 1
+    assert totals['gmail_messages'] == 4
+    assert report['folders']['Work']['verified'] == 1
+    assert report['mislabeled'][0]['id'] == 2
+    assert report['duplicates'][0]['message_id'] == '<d@x>'
+
+    # Without a search of all mail, no missing message is confirmed
+    assert totals['unconfirmed_missing'] == 1
+    assert not report['missing'][0]['confirmed']
+    assert missing == []
+
+
+def test_confirmed_missing(tmp_path):
+    verifier = createVerifier(tmp_path)
+    report, missing = verifier.createReport({'<c@x>'})
+    verifier.close()
+
+    assert report['totals']['unconfirmed_missing'] == 0
+    assert report['missing'][0]['confirmed']
+    assert missing == [('INBOX', 3)]
+
+
+def test_message_found_by_search(tmp_path):
+    verifier = createVerifier(tmp_path)
+
+    # A search of all mail finds the message without a folder label
+    verifier.addGMailMessage('g5', '<c@x>', ['CATEGORY_UPDATES'])
+    assert verifier.missingMessageIDs() == []
+
+    report, missing = verifier.createReport()
+    verifier.close()
+
+    assert report['totals']['missing'] == 0
+    assert report['totals']['mislabeled'] == 2
+    assert missing == []